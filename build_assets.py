@@ -0,0 +1,82 @@
+"""Build the fingerprinted static assets served from /static.
+
+Concatenates Bootstrap with css/baseStyle.css into one minified stylesheet,
+copies jQuery, names every output after a hash of its content and writes
+static/manifest.json mapping logical names to the built files. main.py reads
+the manifest for the asset_url template global. Run after changing any of
+the source files and deploy the static directory with the app:
+
+    python build_assets.py
+"""
+import hashlib
+import json
+import os
+import re
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, 'static')
+MANIFEST = os.path.join(STATIC_DIR, 'manifest.json')
+
+# logical name -> source files concatenated in order
+BUNDLES = {
+    'app.css': ['bower_components/bootstrap/dist/css/bootstrap.min.css',
+                'css/baseStyle.css'],
+    'jquery.js': ['bower_components/jquery/dist/jquery.min.js'],
+}
+
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+SPACE_RE = re.compile(r'\s+')
+PUNCTUATION_RE = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(css):
+    css = COMMENT_RE.sub('', css)
+    css = SPACE_RE.sub(' ', css)
+    css = PUNCTUATION_RE.sub(r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def read(path):
+    with open(os.path.join(ROOT, path), 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def build_bundle(name, sources):
+    parts = [read(source) for source in sources]
+    if name.endswith('.css'):
+        # The bundle is served from /static, point Bootstrap's relative font
+        # urls back at the bootstrap static dir
+        parts = [minify_css(part).replace('../fonts/', '/bootstrap/fonts/')
+                 for part in parts]
+    content = '\n'.join(parts).encode('utf-8')
+    digest = hashlib.md5(content).hexdigest()[:10]
+    base, ext = os.path.splitext(name)
+    filename = '%s.%s%s' % (base, digest, ext)
+    with open(os.path.join(STATIC_DIR, filename), 'wb') as f:
+        f.write(content)
+    return filename
+
+
+def main():
+    if not os.path.isdir(STATIC_DIR):
+        os.makedirs(STATIC_DIR)
+    if os.path.exists(MANIFEST):
+        # remove the files of the previous build
+        with open(MANIFEST) as f:
+            for filename in json.load(f).values():
+                path = os.path.join(STATIC_DIR, filename)
+                if os.path.exists(path):
+                    os.remove(path)
+    manifest = {}
+    for name in sorted(BUNDLES):
+        manifest[name] = build_bundle(name, BUNDLES[name])
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=2, separators=(',', ': '),
+                  sort_keys=True)
+        f.write('\n')
+    for name in sorted(manifest):
+        print('%s -> static/%s' % (name, manifest[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Memcache helpers shared by the models and handlers.
+
+Negative cache: ids that were looked up and did not exist are remembered for a
+short time so repeated probes for them never reach the datastore.
+
+LiveIds: an in-memory Bloom filter of every live id of a kind. An id the
+filter has never seen definitely does not exist. Each instance rebuilds its
+filter every LIVE_IDS_TTL seconds. Ids created since are kept in memcache for
+RECENT_TTL, which is longer, so a filter built before an id was created never
+hides it.
+
+get_or_compute: read-through cache with single-flight recompute. Threads on
+one instance wait on a lock striped by key, and instances coordinate through a
+memcache lease so only one request rebuilds an expired entry while the rest
+wait briefly or serve the previous copy. Entries have a soft and a hard TTL,
+between the two the cached value is served straight away while a deferred
+task rebuilds it in the background. invalidate drops the previous copy too,
+and a rebuild that began before it does not store its result.
+
+Pages: whole rendered pages for anonymous readers, stored together with a
+gzip compressed copy so a hit needs no rendering or compression.
+"""
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+
+import compression
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+NEGATIVE_TTL = 60  # seconds a missing id is remembered
+RECENT_TTL = 60 * 60  # seconds a newly created id is remembered
+LIVE_IDS_TTL = 30 * 60  # seconds before an instance rebuilds its filter
+STALE_TTL = 24 * 60 * 60  # seconds the previous copy of an entry is kept
+LEASE_TTL = 10  # seconds one request may spend recomputing an entry
+REFRESH_LEASE_TTL = 60  # seconds a background refresh may take
+LEASE_WAIT = 2  # seconds other requests wait for the recompute
+LEASE_POLL = 0.1
+PAGE_TTL = 60  # seconds a rendered anonymous page is kept
+KEY_LOCK_STRIPES = 64  # keys share this many per instance rebuild locks
+
+
+def _missing_key(kind, entity_id):
+    return 'missing|%s|%s' % (kind, entity_id)
+
+
+def _recent_key(kind, entity_id):
+    return 'recent|%s|%s' % (kind, entity_id)
+
+
+def mark_missing(kind, entity_id):
+    memcache.set(_missing_key(kind, entity_id), True, time=NEGATIVE_TTL)
+
+
+def clear_missing(kind, entity_id):
+    memcache.delete(_missing_key(kind, entity_id))
+
+
+class BloomFilter(object):
+    """Fixed size Bloom filter over integer ids. No false negatives, false
+    positives at roughly error_rate for up to capacity ids."""
+    def __init__(self, capacity, error_rate = 0.01):
+        capacity = max(capacity, 1000)
+        # standard sizing: m = -n ln p / (ln 2)^2, k = m/n ln 2
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) + 1
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def _positions(self, entity_id):
+        digest = hashlib.md5(str(entity_id)).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, entity_id):
+        for pos in self._positions(entity_id):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, entity_id):
+        for pos in self._positions(entity_id):
+            if not self.bits[pos // 8] & (1 << (pos % 8)):
+                return False
+        return True
+
+
+class LiveIds(object):
+    """Per instance Bloom filter of the live ids of a kind. load_ids is called
+    to list every id when the filter needs rebuilding."""
+    def __init__(self, kind, load_ids):
+        self.kind = kind
+        self.load_ids = load_ids
+        self.built = None
+        self.ids = None
+        self.lock = threading.Lock()
+
+    def expired(self):
+        return self.ids is None or time.time() - self.built > LIVE_IDS_TTL
+
+    def refresh(self):
+        # Only the first thread to find the filter expired rebuilds it, the
+        # others carry on with the old one if there is one
+        if not self.lock.acquire(self.ids is None):
+            return
+        try:
+            if not self.expired():
+                return
+            # The time is taken before listing ids, anything created during
+            # the listing is still in memcache when the filter next expires
+            built = time.time()
+            ids = list(self.load_ids())
+            bloom = BloomFilter(len(ids) * 2)
+            for entity_id in ids:
+                bloom.add(entity_id)
+            self.ids = bloom
+            self.built = built
+        finally:
+            self.lock.release()
+
+    def added(self, entity_id):
+        # Called after an entity of this kind is created
+        memcache.set(_recent_key(self.kind, entity_id), True, time=RECENT_TTL)
+        clear_missing(self.kind, entity_id)
+        if self.ids is not None:
+            self.ids.add(entity_id)
+
+
+def known_missing(kind, entity_id, live_ids = None):
+    """Return True if entity_id is known not to exist without touching the
+    datastore. Costs a single memcache round trip."""
+    keys = [_missing_key(kind, entity_id)]
+    if live_ids:
+        keys.append(_recent_key(kind, entity_id))
+    found = memcache.get_multi(keys)
+    if keys[0] in found:
+        return True
+    if not live_ids or keys[1] in found:
+        return False
+    if live_ids.expired():
+        live_ids.refresh()
+    return int(entity_id) not in live_ids.ids
+
+
+# A fixed pool of locks striped by key, so keys made from URL ids cannot grow
+# it. Keys sharing a stripe only wait on each other's rebuilds
+_key_locks = [threading.Lock() for i in range(KEY_LOCK_STRIPES)]
+
+
+def _key_lock(key):
+    digest = hashlib.md5(key).digest()
+    return _key_locks[struct.unpack('<I', digest[:4])[0] % KEY_LOCK_STRIPES]
+
+
+def _writes_key(key):
+    return 'writes|' + key
+
+
+def invalidate(key):
+    # Called after the data behind key changed. The previous copy goes too,
+    # so no reader is served the value from before the write, and the write
+    # count moves so a rebuild already under way does not store what it read
+    # before the write
+    memcache.incr(_writes_key(key), initial_value=0)
+    memcache.delete_multi([key, 'stale|' + key])
+
+
+def _writes(key):
+    return memcache.get(_writes_key(key))
+
+
+def _store(key, value, soft_ttl, hard_ttl, writes):
+    # Entries carry the time they stop being fresh; memcache drops them at
+    # the hard TTL. Nothing is stored if key was invalidated since writes was
+    # read, before compute ran
+    if _writes(key) != writes:
+        return
+    entry = (value, time.time() + soft_ttl)
+    memcache.set(key, entry, time=hard_ttl)
+    memcache.set('stale|' + key, entry, time=STALE_TTL)
+
+
+def _refresh(key, compute, args, soft_ttl, hard_ttl):
+    # Runs on the deferred task queue to rebuild an entry past its soft TTL
+    try:
+        writes = _writes(key)
+        value = compute(*args)
+        if value is None:
+            memcache.delete(key)
+        else:
+            _store(key, value, soft_ttl, hard_ttl, writes)
+    finally:
+        memcache.delete('lease|' + key)
+
+
+def get_or_compute(key, compute, args = (), soft_ttl = 60, hard_ttl = 60 * 60):
+    """Return the cached value for key, calling compute(*args) to rebuild it.
+    compute must be a module level function so it can be deferred. Past
+    soft_ttl the cached value is still returned while a background task
+    rebuilds it, past hard_ttl the caller rebuilds it. compute returning None
+    is not cached."""
+    entry = memcache.get(key)
+    if entry is not None:
+        value, fresh_until = entry
+        if time.time() > fresh_until and memcache.add(
+                'lease|' + key, True, time=REFRESH_LEASE_TTL):
+            try:
+                deferred.defer(_refresh, key, compute, args, soft_ttl, hard_ttl)
+            except (taskqueue.Error, deferred.Error):
+                logging.exception('Could not queue refresh of %s', key)
+                memcache.delete('lease|' + key)
+        return value
+    with _key_lock(key):
+        # another thread on this instance may have rebuilt it while we waited
+        entry = memcache.get(key)
+        if entry is not None:
+            return entry[0]
+        lease_key = 'lease|' + key
+        if memcache.add(lease_key, True, time=LEASE_TTL):
+            try:
+                writes = _writes(key)
+                value = compute(*args)
+                if value is not None:
+                    _store(key, value, soft_ttl, hard_ttl, writes)
+            finally:
+                memcache.delete(lease_key)
+            return value
+    # Another instance is recomputing, serve the previous copy if there is
+    # one, none is kept past an invalidate, otherwise wait a moment for the
+    # fresh value. The lock is released
+    # first so waiting threads poll side by side rather than in turn
+    entry = memcache.get('stale|' + key)
+    if entry is not None:
+        return entry[0]
+    deadline = time.time() + LEASE_WAIT
+    while time.time() < deadline:
+        time.sleep(LEASE_POLL)
+        entry = memcache.get(key)
+        if entry is not None:
+            return entry[0]
+    return compute(*args)
+
+
+def _page_key(path):
+    return 'page|' + path
+
+
+def get_page(path):
+    # Returns {'body': html, 'gzip': compressed html} or None
+    return memcache.get(_page_key(path))
+
+
+def set_page(path, body):
+    page = {'body': body, 'gzip': compression.gzip_bytes(body)}
+    memcache.set(_page_key(path), page, time=PAGE_TTL)
+
+
+def invalidate_pages(*paths):
+    memcache.delete_multi([_page_key(path) for path in paths])
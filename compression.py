@@ -0,0 +1,72 @@
+"""Gzip compression of responses for clients that accept it."""
+import gzip
+import StringIO
+
+COMPRESS_LEVEL = 6
+MIN_SIZE = 1024  # bytes, smaller bodies are sent as they are
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/atom+xml', 'application/xml')
+
+
+def accepts_gzip(environ):
+    return 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+
+
+def gzip_bytes(data):
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=COMPRESS_LEVEL)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+
+
+class GzipMiddleware(object):
+    """WSGI middleware compressing successful text responses when the client
+    sends Accept-Encoding: gzip. Responses that already carry a
+    Content-Encoding, such as precompressed cached pages, pass through."""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not accepts_gzip(environ):
+            return self.app(environ, start_response)
+
+        captured = []
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return written.append
+
+        result = self.app(environ, capture)
+        try:
+            body = ''.join(written) + ''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers, exc_info = captured
+
+        content_type = _header(headers, 'Content-Type') or ''
+        if (not status.startswith('200') or len(body) < MIN_SIZE
+                or _header(headers, 'Content-Encoding')
+                or not content_type.startswith(COMPRESSIBLE_TYPES)):
+            start_response(status, headers, exc_info)
+            return [body]
+
+        body = gzip_bytes(body)
+        headers = [(k, v) for k, v in headers
+                   if k.lower() not in ('content-length', 'vary')]
+        vary = _header(captured[1], 'Vary')
+        headers += [('Content-Encoding', 'gzip'),
+                    ('Content-Length', str(len(body))),
+                    ('Vary', vary + ', Accept-Encoding' if vary
+                     else 'Accept-Encoding')]
+        start_response(status, headers, exc_info)
+        return [body]
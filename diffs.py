@@ -0,0 +1,101 @@
+"""Compact line based deltas between two versions of a text.
+
+A delta is a list of operations applied to the lines of a base text in
+order: a positive int copies that many lines, a negative int skips that many
+lines and a string is inserted as is. Unchanged runs cost one int however
+long they are, so a small edit to a long post makes a small delta. Deltas are
+stored as JSON, see model.PostRevision.
+"""
+import difflib
+import json
+
+
+def _lines(text):
+    return text.splitlines(True)
+
+
+def delta(base, target):
+    """Return the delta that turns base into target"""
+    base_lines, target_lines = _lines(base), _lines(target)
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines,
+                                      autojunk=False)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append(u''.join(target_lines[j1:j2]))
+    return ops
+
+
+def patch(base, ops):
+    """Apply a delta made by delta to base"""
+    base_lines = _lines(base)
+    position = 0
+    parts = []
+    for op in ops:
+        if isinstance(op, basestring):
+            parts.append(op)
+        elif op > 0:
+            parts.extend(base_lines[position:position + op])
+            position += op
+        else:
+            position -= op
+    return u''.join(parts)
+
+
+def dumps(ops):
+    return json.dumps(ops, separators=(',', ':'))
+
+
+def loads(data):
+    return json.loads(data)
+
+
+def splice(content, start, remove, text):
+    """Replace remove characters at start of content with text, or return
+    None for a range outside content. Positions count UTF-16 code units as
+    the editor does, so astral characters line up"""
+    units = content.encode('utf-16-le')
+    start, end = start * 2, (start + remove) * 2
+    if start < 0 or remove < 0 or end > len(units):
+        return None
+    try:
+        return (units[:start] + text.encode('utf-16-le') +
+                units[end:]).decode('utf-16-le')
+    except UnicodeDecodeError:
+        # start or end split a surrogate pair
+        return None
+
+
+def snapshot_after(version, latest, every):
+    """Return the first version at or after version that keeps a full
+    snapshot, a multiple of every, or latest if that comes first"""
+    return min(latest, -(-version // every) * every)
+
+
+def chain(version, latest, every):
+    """Return the versions whose stored revisions rebuild version of a text
+    now at latest: version up to the first snapshot after it, or up to but
+    not including latest when the current text comes first"""
+    end = snapshot_after(version, latest, every)
+    return range(version, end + 1 if end < latest else end)
+
+
+def rebuild(version, latest, every, content, revisions):
+    """Rebuild version of a text whose current content is at latest.
+    revisions are the (snapshot, delta) pairs stored for the versions of
+    chain, None where one is missing. Every every-th revision is a snapshot,
+    the others hold the delta from the next version back to theirs. Returns
+    None if a revision needed is missing"""
+    end = snapshot_after(version, latest, every)
+    if end < latest:
+        content = revisions[-1] and revisions[-1][0]
+    for revision in reversed(revisions[:end - version]):
+        if revision is None or content is None:
+            return None
+        content = patch(content, loads(revision[1]))
+    return content
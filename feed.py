@@ -0,0 +1,64 @@
+"""Atom feed of the latest posts.
+
+The feed is built from its own strongly consistent query for the latest
+FEED_SIZE posts and kept in memcache as a single blob together with its
+ETag. The post create, edit and delete paths invalidate it (see
+model.FEED_KEY), so readers polling the feed cost one cache lookup and,
+when they send If-None-Match, usually get a 304. A build that raced an edit
+is only kept for FEED_TTL.
+"""
+import hashlib
+from xml.sax.saxutils import escape, quoteattr
+
+from google.appengine.api import app_identity
+from google.appengine.api import memcache
+
+import model
+
+FEED_SIZE = 20
+FEED_TTL = 5 * 60  # seconds, also rebuilt when a post changes
+TITLE = 'Multi-User Blog'
+
+
+def _timestamp(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _build_feed():
+    site = 'https://%s' % app_identity.get_default_version_hostname()
+    posts = model.latest_posts(FEED_SIZE)
+    updated = max([p.last_modified for p in posts]) if posts else None
+
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<feed xmlns="http://www.w3.org/2005/Atom">',
+             '<title>%s</title>' % escape(TITLE),
+             '<id>%s/</id>' % escape(site),
+             '<link href=%s/>' % quoteattr(site + '/'),
+             '<link rel="self" href=%s/>' % quoteattr(site + '/feed.xml')]
+    if updated:
+        lines.append('<updated>%s</updated>' % _timestamp(updated))
+    for post in posts:
+        url = '%s/%d' % (site, post.key().id())
+        lines += ['<entry>',
+                  '<title>%s</title>' % escape(post.subject),
+                  '<id>%s</id>' % escape(url),
+                  '<link href=%s/>' % quoteattr(url),
+                  '<author><name>%s</name></author>' % escape(post.author),
+                  '<published>%s</published>' % _timestamp(post.created),
+                  '<updated>%s</updated>' % _timestamp(post.last_modified),
+                  '<content type="html">%s</content>' % escape(
+                      post.contentHtml or escape(post.content)),
+                  '</entry>']
+    lines.append('</feed>')
+    body = u'\n'.join(lines).encode('utf-8')
+    return {'body': body, 'etag': hashlib.md5(body).hexdigest()}
+
+
+def get_feed():
+    # {'body': atom xml, 'etag': etag of the body}. Never served from a
+    # stale copy
+    atom = memcache.get(model.FEED_KEY)
+    if atom is None:
+        atom = _build_feed()
+        memcache.set(model.FEED_KEY, atom, time=FEED_TTL)
+    return atom
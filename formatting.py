@@ -0,0 +1,43 @@
+"""Text processing for blog posts. Run once when a post is written so the
+views only ever print the stored results."""
+import cgi
+import re
+
+EXCERPT_LENGTH = 300
+MAX_TAGS = 10
+
+TAG_RE = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+
+PARAGRAPH_RE = re.compile(r'\n\s*\n')
+
+
+def make_excerpt(content, length = EXCERPT_LENGTH):
+    # Collapse whitespace and cut on a word boundary for the front page
+    text = ' '.join(content.split())
+    if len(text) <= length:
+        return text
+    cut = text[:length].rsplit(' ', 1)[0]
+    return cut + u'\u2026'
+
+
+def render_html(content):
+    # Escape everything the user typed, then turn blank lines into paragraphs
+    # and single newlines into line breaks
+    content = content.replace('\r\n', '\n').strip()
+    paragraphs = []
+    for paragraph in PARAGRAPH_RE.split(content):
+        paragraph = cgi.escape(paragraph.strip(), quote = True)
+        if paragraph:
+            paragraphs.append('<p>%s</p>' % paragraph.replace('\n', '<br>\n'))
+    return '\n'.join(paragraphs)
+
+
+def parse_tags(text):
+    # Comma separated tags from the post form, lower cased, deduplicated and
+    # limited to letters, digits and dashes
+    tags = []
+    for tag in text.lower().split(','):
+        tag = '-'.join(tag.split())
+        if TAG_RE.match(tag) and tag not in tags:
+            tags.append(tag)
+    return tags[:MAX_TAGS]
@@ -14,13 +14,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import urllib
+import base64
+import datetime
+import json
 
 import webapp2
 import os
 import jinja2
+from google.appengine.ext import db
+from google.appengine.ext import deferred
 
+import cache
+import compression
+import feed
+import formatting
 import model
+import related
+import search
+import spam
+import storage
 import user_accounts
 
 # Create Template directory path, Initialize Jinja, set autoescape to true
@@ -29,7 +41,75 @@ template_dir = os.path.join(os.path.dirname(__file__), 'templates')
 jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
                                autoescape=True)
 
+# Fingerprinted static assets written by build_assets.py. Templates reference
+# them by logical name through asset_url so they can be cached forever
+with open(os.path.join(os.path.dirname(__file__), 'static',
+                       'manifest.json')) as manifest:
+    ASSETS = json.load(manifest)
+
+def asset_url(name):
+    return '/static/' + ASSETS[name]
+
+jinja_env.globals['asset_url'] = asset_url
+
+# Cache-Control for anonymous reads of public pages, shared caches may keep
+# them for PUBLIC_MAX_AGE seconds and serve them stale while refetching
+PUBLIC_MAX_AGE = 60
+PUBLIC_STALE_WHILE_REVALIDATE = 300
+
 class Handler(webapp2.RequestHandler):
+    # Set on handlers whose anonymous GET pages are public, they may be served
+    # from the page cache and by shared caches, see dispatch
+    page_cacheable = False
+
+    def public_request(self):
+        # Anonymous GET of a canonical public page with no messages to show
+        return (self.page_cacheable and self.request.method == 'GET'
+                and not self.user and not self.request.query_string
+                and 'flash' not in self.request.cookies)
+
+    def dispatch(self):
+        # Anonymous GETs of public pages are served from the page cache,
+        # compressed or not to match Accept-Encoding, and stored on a miss.
+        # Every response then gets its caching headers
+        public = self.public_request()
+        if not public:
+            webapp2.RequestHandler.dispatch(self)
+        else:
+            page = cache.get_page(self.request.path)
+            if page:
+                self.add_vary('Accept-Encoding')
+                if compression.accepts_gzip(self.request.environ):
+                    self.response.headers['Content-Encoding'] = 'gzip'
+                    self.response.body = page['gzip']
+                else:
+                    self.response.body = page['body']
+            else:
+                webapp2.RequestHandler.dispatch(self)
+                if self.response.status_int == 200:
+                    cache.set_page(self.request.path, self.response.body)
+        self.set_cache_policy(public)
+
+    def set_cache_policy(self, public):
+        # Public pages may be cached by the edge cache and proxies, keyed on
+        # the cookie so signed in readers never get the anonymous copy.
+        # Anything else, signed in or mutating, must not be stored. Handlers
+        # that set their own Cache-Control keep it, webapp2's default is
+        # no-cache
+        if self.response.headers.get('Cache-Control', 'no-cache') != 'no-cache':
+            return
+        if public and self.response.status_int == 200:
+            self.response.headers['Cache-Control'] = (
+                'public, max-age=%d, stale-while-revalidate=%d'
+                % (PUBLIC_MAX_AGE, PUBLIC_STALE_WHILE_REVALIDATE))
+            self.add_vary('Cookie')
+        else:
+            self.response.headers['Cache-Control'] = 'private, no-store'
+
+    def add_vary(self, header):
+        vary = self.response.headers.get('Vary')
+        self.response.headers['Vary'] = '%s, %s' % (vary, header) if vary else header
+
     def write(self, *a, **kw):
         self.response.write(*a, **kw)
 
@@ -38,24 +118,65 @@ class Handler(webapp2.RequestHandler):
         return t.render(params)
 
     def render(self, template, **kw):
-        message = self.request.get('message')
-        if self.posts:
-            if self.user:
-                self.write(self.render_str(template, user=self.user,
-                                           posts=self.posts, message=message, **kw))
-            else:
-                self.write(self.render_str(template, posts=self.posts, **kw))
-        else:
-            if self.user:
-                self.write(self.render_str(template, user=self.user, message=message, **kw))
-            else:
-                self.write(self.render_str(template, **kw))
+        # Status messages flashed by the previous request fill in the
+        # template's message and error variables
+        params = self.read_flash()
+        params.update(kw)
+        if self.user:
+            params['user'] = self.user
+        params['tagCloud'] = model.get_tag_cloud()
+        params['archive'] = model.get_archive()
+        self.write(self.render_str(template, **params))
+
+    def write_json(self, obj):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(obj))
+
+    def like(self, post):
+        # Like a post as the signed in user, returns an error message or an
+        # empty string if the like was recorded
+        if not self.user: # must be logged in to use the like button
+            return "You must be signed in to like a post!"
+        if post.author == self.user.userName: # Cant like own post
+            return "You cannot like your own post!"
+        if not post.addLike(self.user.userName): # buffer the like
+            return "You've already liked the post! Cannot like it again!"
+        return ""
+
+    def request_version(self):
+        # Version of the entity the edit form was opened on, see
+        # BlogPost.update
+        try:
+            return int(self.request.get('version'))
+        except ValueError:
+            return None
 
     def set_cookie(self, name, val):
         # Create secure cookie, deletes when browser closes
         cookie_val = user_accounts.make_secure_val(val)
         self.response.headers.add_header('Set-Cookie',
-                                         '%s=%s' % (name,cookie_val))
+                                         '%s=%s; Path=/' % (name,cookie_val))
+
+    def flash_redirect(self, uri, messages):
+        # Redirect, passing status messages to the next page in a signed one
+        # shot cookie so the redirected URL stays canonical and cacheable
+        messages = dict((k, v) for k, v in messages.items() if v)
+        if messages:
+            self.set_cookie('flash', base64.urlsafe_b64encode(json.dumps(messages)))
+        self.redirect(uri)
+
+    def read_flash(self):
+        # Read and clear the messages set by flash_redirect
+        if 'flash' not in self.request.cookies:
+            return {}
+        self.response.delete_cookie('flash')
+        value = self.read_cookie('flash')
+        if not value:
+            return {}
+        try:
+            return json.loads(base64.urlsafe_b64decode(str(value)))
+        except (TypeError, ValueError):
+            return {}
 
     def read_cookie(self, name):
         # First check if cookie exists then check if cookie passes
@@ -65,7 +186,7 @@ class Handler(webapp2.RequestHandler):
 
     def login(self, user):
         # Set the cookie for a logged in user
-        self.set_cookie('user_id', str(user.key().id()))
+        self.set_cookie('user_id', user.cookieId())
 
     def logout(self):
         # Delete the cookie for a logged in user
@@ -75,16 +196,29 @@ class Handler(webapp2.RequestHandler):
         # Check if user is logged in at every request
         webapp2.RequestHandler.initialize(self, *a, **kw)
         user_id = self.read_cookie('user_id')
-        self.user = user_id and model.User.by_id(int(user_id))
-        # Check database for posts at every request to render on aside list
-        posts = model.BlogPost.all().order('-created')
-        if posts:
-            self.posts = posts # Now available in all views
+        self.user = user_id and model.User.by_id(user_id)
 
 
 class MainHandler(Handler):
+    page_cacheable = True
+
     def get(self):
-        self.render("main.html", title="Multi-User Blog")
+        # The first page comes from the cache, older pages are passed the
+        # creation time of the last post on the page before
+        before = self.request.get('before')
+        if before:
+            try:
+                posts = model.BlogPost.older_than(datetime.datetime.strptime(
+                    before, model.PAGE_TIME_FORMAT))
+            except ValueError:
+                self.abort(400)
+        else:
+            posts = model.get_recent_posts()
+        olderPage = None
+        if len(posts) == model.POST_PAGE_SIZE:
+            olderPage = posts[-1].created.strftime(model.PAGE_TIME_FORMAT)
+        self.render("main.html", title="Multi-User Blog", posts=posts,
+                    olderPage=olderPage)
 
 
 class SignUp(Handler):
@@ -94,9 +228,8 @@ class SignUp(Handler):
     If inputs pass all input checks, check database is username is available
     if username is available, add user to database, sign user in, reload page"""
     def get(self):
-        loginError = self.request.get('loginError')
-        self.render('signup.html', title="Multi-User Blog Registration",
-                    loginError=loginError)
+        # loginError is flashed by handlers that require signing in
+        self.render('signup.html', title="Multi-User Blog Registration")
 
     def post(self):
         # Grab sign up parameters
@@ -151,7 +284,7 @@ class Login(Handler):
             self.redirect('/')
         else:
             query_params = {'loginError': 'Invalid Username or Password'}
-            self.redirect('/signup?'+urllib.urlencode(query_params))
+            self.flash_redirect('/signup', query_params)
 
 class Logout(Handler):
     def post(self):
@@ -165,74 +298,238 @@ class BlogPost(Handler):
     def get(self):
         # render page for new blog post
         if self.user:
-            self.render('blogPost.html', title="New Blog Post")
+            draft = model.load_draft(self.user.userName, 'new')
+            if draft:
+                self.render('blogPost.html', title="New Blog Post",
+                            subject=draft['subject'], content=draft['content'],
+                            tags=draft['tags'], draftID='new',
+                            draftRevision=draft['revision'],
+                            draftNotice="Restored your unsaved draft")
+            else:
+                self.render('blogPost.html', title="New Blog Post", draftID='new')
         else:
             query_params = {'loginError': 'Must be logged in to make a blog post'}
-            self.redirect('/signup?'+urllib.urlencode(query_params))
+            self.flash_redirect('/signup', query_params)
 
     def post(self):
         # Get new post subject and content
         if self.user:
             subject = self.request.get('subject')
             content = self.request.get('content')
+            tags = self.request.get('tags')
 
             if subject and content:
                 # push new blogpost to datastore
-                post = model.BlogPost(subject = subject,
-                                      content = content,
-                                      author = self.user.userName)
-                postKey = post.put()
+                post = model.BlogPost.create(subject = subject,
+                                             content = content,
+                                             author = self.user.userName,
+                                             tags = formatting.parse_tags(tags))
+                postKey = post.publish()
+                deferred.defer(related.add_post, postKey)
+                model.discard_draft(self.user.userName, 'new')
                 self.redirect('/%s' % str(postKey.id()))
             else:
                 error = "Please enter a Subject and Content for the Blog Post"
                 self.render('blogPost.html', title="New Blog Post", postError=error,
-                            subject = subject, content = content)
+                            subject = subject, content = content, tags = tags,
+                            draftID='new')
         else:
             #user is not signed in.
             query_params = {'loginError': "You must be signed in to make a blog post"}
-            self.redirect('/signup?%s' % (urllib.urlencode(query_params)))
+            self.flash_redirect('/signup', query_params)
 
 
 class PostPage(Handler):
     """PostPage displays a single blog post at a time with the comments. From 
     this page a user can like a post or add a comment
     heavily using the get call here via redirects on other handlers and passing
-    the error messages through get parameters called modifyError and commentError"""
+    the error messages through flash cookies called modifyError and commentError"""
+    page_cacheable = True
+
     def get(self, post_id):
-        # Pass Errors from incorrect users attempting to modify or comment
-        # a blog post in the URI get parameters.
-        modifyError = self.request.get('modifyError')
-        commentError = self.request.get('commentError')
-        post = model.BlogPost.get_by_id(int(post_id))
-        comments = model.Comment.get_comments_by_blogID(post_id)
-        self.render('singlePost.html', title="Blog Post Detail", post=post,
-                    comments=comments, modifyError=modifyError,
-                    commentError=commentError)
+        # Errors from incorrect users attempting to modify or comment a blog
+        # post are flashed as modifyError and commentError, see render
+        page = model.get_post_page(post_id)
+        if page:
+            post, comments, commentCursor, related = page
+            likes = post.likesLength() + post.pendingLikes()
+            self.render('singlePost.html', title="Blog Post Detail", post=post,
+                        comments=comments, commentCursor=commentCursor,
+                        likes=likes, related=related)
+        else:
+            query_params = {'message': "That blog post does not exist"}
+            self.flash_redirect('/', query_params)
 
     def post(self, post_id):
         # This post method is used by the like button to increase the number
         # of likes a blogpost has. The likes are stored as a StringListProperty
-        # of the users who have liked the blogpost.
+        # of the users who have liked the blogpost, they are buffered and
+        # written in batches by FlushLikes.
 
         post = model.BlogPost.exists(post_id)
         if post:
-            if self.user: # must be logged in to use the like button
-                if post.author != self.user.userName: # Cant like own post
-                    if not self.user.userName in post.likes:
-                        post.addLike(self.user.userName) # add user to list
-                        query_params = {'commentError': ""}
-                    else:
-                        query_params = {'commentError': "You've already liked the post! Cannot like it again!"}
-                else:
-                    query_params = {'commentError': "You cannot like your own post!"}
-            else:
-                query_params = {'commentError': "You must be signed in to like a post!"}
-            self.redirect('/%s?%s' % (post_id, urllib.urlencode(query_params)))
+            query_params = {'commentError': self.like(post)}
+            self.flash_redirect('/%s' % post_id, query_params)
         else:
             query_params = {'message': "Like failed - that post does not exist"}
-            self.redirect('/?%s' % (urllib.urlencode(query_params)))
+            self.flash_redirect('/', query_params)
+
+
+
+class LikeApi(Handler):
+    """JSON version of the like button used by singlePost.html, returns the
+    new like count without redirecting back to the post page"""
+    def post(self, post_id):
+        post = model.BlogPost.exists(post_id)
+        if post:
+            error = self.like(post)
+            self.write_json({'liked': not error,
+                             'likes': post.likesLength() + post.pendingLikes(),
+                             'error': error})
+        else:
+            self.response.set_status(404)
+            self.write_json({'liked': False, 'likes': 0,
+                             'error': "Like failed - that post does not exist"})
+
+
+class DraftApi(Handler):
+    """Autosave for blogPost.html. Takes one edit to the signed in user's
+    draft of a new post ('new') or of an edit to their post, either the whole
+    content or a splice (start, remove, text) against draft revision base.
+    Answers 409 when the splice no longer applies so the editor resends the
+    whole content, see model.save_draft_edit"""
+    def post(self, draft_id):
+        if not self.user:
+            self.response.set_status(403)
+            self.write_json({'revision': None})
+            return
+        if draft_id != 'new':
+            post = model.BlogPost.exists(draft_id)
+            if not post or post.author != self.user.userName:
+                self.response.set_status(404)
+                self.write_json({'revision': None})
+                return
+        content = self.request.get('content', None)
+        try:
+            edit = {} if content is not None else {
+                'base': int(self.request.get('base')),
+                'start': int(self.request.get('start')),
+                'remove': int(self.request.get('remove')),
+                'text': self.request.get('text')}
+        except ValueError:
+            self.abort(400)
+        revision = model.save_draft_edit(
+            self.user.userName, draft_id, self.request.get('subject'),
+            self.request.get('tags'), content=content, **edit)
+        if revision is None:
+            self.response.set_status(409)
+        self.write_json({'revision': revision})
+
+
+class AuthorPage(Handler):
+    """Lists the posts of one author newest first, a page at a time. The
+    cursor for the next page is passed as a get parameter"""
+    def get(self, author):
+        try:
+            posts, cursor = model.BlogPost.by_author(author,
+                                                     self.request.get('cursor'))
+        except (db.BadRequestError, db.BadValueError):
+            self.abort(400)
+        self.render('author.html', title="Posts by %s" % author, author=author,
+                    authorPosts=posts, cursor=cursor,
+                    postCount=model.author_post_count(author))
+
+
+class TagPage(Handler):
+    """Lists the posts with a tag newest first, a page at a time. The cursor
+    for the next page is passed as a get parameter"""
+    def get(self, tag):
+        try:
+            posts, cursor = model.BlogPost.by_tag(tag, self.request.get('cursor'))
+        except (db.BadRequestError, db.BadValueError):
+            self.abort(400)
+        self.render('tag.html', title="Posts tagged %s" % tag, tag=tag,
+                    tagPosts=posts, cursor=cursor)
+
+
+class ArchivePage(Handler):
+    """Lists the posts created in one month newest first, a page at a time.
+    The cursor for the next page is passed as a get parameter"""
+    def get(self, year, month):
+        year, month = int(year), int(month)
+        # by_month needs the first day of the next month, which does not
+        # exist after December of MAXYEAR
+        if not 1 <= month <= 12 or not 1900 <= year < datetime.MAXYEAR:
+            self.abort(404)
+        try:
+            posts, cursor = model.BlogPost.by_month(year, month,
+                                                    self.request.get('cursor'))
+        except (db.BadRequestError, db.BadValueError):
+            self.abort(400)
+        self.render('archive.html', title="Posts from %04d-%02d" % (year, month),
+                    year=year, month=month, monthPosts=posts, cursor=cursor)
+
+
+class FeedPage(Handler):
+    """Atom feed of the latest posts served from the cached blob in feed.py,
+    with a 304 when the reader already has the current version"""
+    def get(self):
+        atom = feed.get_feed()
+        self.response.headers['Content-Type'] = 'application/atom+xml; charset=utf-8'
+        self.response.headers['Cache-Control'] = 'public, max-age=300'
+        self.response.etag = atom['etag']
+        if atom['etag'] in self.request.if_none_match:
+            self.response.status = 304
+        else:
+            self.response.body = atom['body']
 
 
+class SearchPage(Handler):
+    """Full text search of blog posts, see search.py. The query and result
+    page are passed as q and page get parameters"""
+    def get(self):
+        query = self.request.get('q')
+        try:
+            page = max(0, int(self.request.get('page') or 0))
+        except ValueError:
+            page = 0
+        postIDs, more = search.search(query, page)
+        results = model.BlogPost.by_ids(postIDs)
+        self.render('search.html', title="Search", query=query,
+                    results=results, page=page, more=more)
+
+
+class CommentsPage(Handler):
+    """Returns a page of comments as an HTML fragment with the cursor for the
+    following page. Used by singlePost.html to load comments after the first
+    page, which is rendered with the post"""
+    def get(self, post_id):
+        cursor = self.request.get('cursor')
+        try:
+            comments, cursor = model.Comment.page(post_id, cursor)
+        except (db.BadRequestError, db.BadValueError):
+            self.response.set_status(400)
+            self.write_json({'html': '', 'cursor': None})
+            return
+        html = self.render_str('comments.html', comments=comments,
+                               user=self.user)
+        self.write_json({'html': html, 'cursor': cursor})
+
+
+class RevisionPage(Handler):
+    """Shows one version of a post, rebuilt from its stored revisions, with
+    links to the versions before and after it"""
+    def get(self, post_id, version):
+        version = int(version)
+        found = model.BlogPost.revision(post_id, version)
+        if not found:
+            self.abort(404)
+        revision, content = found
+        post = model.BlogPost.exists(post_id)
+        self.render('revision.html', title="Blog Post History", postID=post_id,
+                    revision=revision, version=version,
+                    latest=post.version, contentHtml=formatting.render_html(content))
+
 
 class ModifyBlog(Handler):
     def get(self, post_id):
@@ -244,17 +541,28 @@ class ModifyBlog(Handler):
             if post:
                 if post.author != self.user.userName: # Cant modify someone elses post
                     query_params = {'modifyError': "Sorry - Cannot modify a post you did not author"}
-                    self.redirect('/%s?%s' % (post_id, urllib.urlencode(query_params)))
+                    self.flash_redirect('/%s' % post_id, query_params)
                 else:
-                    # display blogPost page with previous content for modification
-                    self.render('blogPost.html', title="Modify Blog Post",
-                                subject=post.subject, content=post.content, id=post_id)
+                    # display blogPost page with previous content for modification,
+                    # or with the unsaved draft of an earlier edit
+                    draft = model.load_draft(self.user.userName, post_id)
+                    if draft:
+                        self.render('blogPost.html', title="Modify Blog Post",
+                                    subject=draft['subject'], content=draft['content'],
+                                    tags=draft['tags'], id=post_id, version=post.version,
+                                    draftID=post_id, draftRevision=draft['revision'],
+                                    draftNotice="Restored your unsaved draft")
+                    else:
+                        self.render('blogPost.html', title="Modify Blog Post",
+                                    subject=post.subject, content=post.content, id=post_id,
+                                    version=post.version, tags=', '.join(post.tags),
+                                    draftID=post_id)
             else:
                 query_params = {'message': "That blog post does not exist"}
-                self.redirect('/?%s' % (urllib.urlencode(query_params)))
+                self.flash_redirect('/', query_params)
         else:
             query_params = {'loginError': "You must be signed in to delete or modify a blog post"}
-            self.redirect('/signup?%s' % (urllib.urlencode(query_params)))
+            self.flash_redirect('/signup', query_params)
 
 
     def post(self, post_id):
@@ -268,36 +576,61 @@ class ModifyBlog(Handler):
             if post:
                 if post.author != self.user.userName:
                     query_params = {'modifyError': "Sorry - Cannot delete a post you did not author"}
-                    self.redirect('/%s?%s' % (post_id, urllib.urlencode(query_params)))
+                    self.flash_redirect('/%s' % post_id, query_params)
                 else:
                     if delete:
                         post.delete() #delete the blog post and all associated comments
+                        model.PostRevision.delete_all(post.key())
+                        model.discard_draft(self.user.userName, post_id)
                         comments = model.Comment.get_comments_by_blogID(post_id)
                         for comment in comments:
                             comment.delete()
-                        query_params = {'message': "Blog Post Deleted. "
-                                                   "Page may need to be refreshed to reflect changes"}
-                        self.redirect('/?%s' % urllib.urlencode(query_params))
+                        query_params = {'message': "Blog Post Deleted."}
+                        self.flash_redirect('/', query_params)
                     else:
                         # Save the blog updates.
                         subject = self.request.get('subject')
                         content = self.request.get('content')
+                        tags = self.request.get('tags')
                         if subject and content:
-                            post.subject = subject
-                            post.content = content
-                            post.put()
-                            self.redirect('/%s' % post_id)
+                            post, saved = model.BlogPost.update(
+                                post_id, self.request_version(), subject, content,
+                                formatting.parse_tags(tags))
+                            if saved:
+                                model.discard_draft(self.user.userName, post_id)
+                                self.redirect('/%s' % post_id)
+                            elif post is None:
+                                query_params = {'message': "That blog post does not exist"}
+                                self.flash_redirect('/', query_params)
+                            else:
+                                # The post changed since the form was opened,
+                                # show the edit again against the new version
+                                error = ("This post was changed since you started editing. "
+                                         "Submit again to replace it with your version")
+                                self.render('blogPost.html', title="Modify Blog Post",
+                                            postError=error, subject=subject, content=content,
+                                            tags=tags, id=post_id, version=post.version,
+                                            draftID=post_id)
                         else:
                             # Error handling for updating blog post.
                             error = "Blog Post must have a subject and content"
                             self.render('blogPost.html', title="Modify Blog Post", postError=error,
-                                        subject=subject, content=content)
+                                        subject=subject, content=content, tags=tags,
+                                        id=post_id, version=self.request.get('version'),
+                                        draftID=post_id)
             else:
                 query_params = {'message': "That blog post does not exist"}
-                self.redirect('/?%s' % (urllib.urlencode(query_params)))
+                self.flash_redirect('/', query_params)
         else:
             query_params = {'loginError': "You must be signed in to delete or modify a blog post"}
-            self.redirect('/signup?%s' % (urllib.urlencode(query_params)))
+            self.flash_redirect('/signup', query_params)
+
+# Errors for comments refused by spam.check
+SPAM_ERRORS = {
+    spam.DUPLICATE: "You already posted a comment like this one",
+    spam.FLOOD: ("Too many similar comments were posted on this post recently, "
+                 "please try again later"),
+}
 
 class CommentBlog(Handler):
     """Methods to add and review comments.
@@ -310,10 +643,10 @@ class CommentBlog(Handler):
                 self.render('singlePost.html', title="Add Comment", commentActive=True, post=post)
             else:
                 query_params = {'commentError': "You must be signed in to comment on a post!"}
-                self.redirect('/%s?%s' % (post_id, urllib.urlencode(query_params)))
+                self.flash_redirect('/%s' % post_id, query_params)
         else:
             query_params = {'message': "That blog post does not exist"}
-            self.redirect('/?%s' % (urllib.urlencode(query_params)))
+            self.flash_redirect('/', query_params)
 
     def post(self, post_id):
         # Post method pushes comment content to data store
@@ -321,97 +654,135 @@ class CommentBlog(Handler):
         post = model.BlogPost.exists(post_id)
         if post:
             if self.user:
-                if commentContent:
-                    comment = model.Comment(blogPost= int(post_id),
-                                            content= commentContent,
-                                            author = self.user.userName)
-                    comment.put()
-                    post.comments += 1
-                    post.put()
+                spamCheck = commentContent and spam.check(
+                    commentContent, self.user.userName, post_id)
+                if commentContent and not spamCheck:
+                    comment = model.Comment.add(post_id, commentContent,
+                                                self.user.userName)
+                    if comment:
+                        spam.record(commentContent, self.user.userName,
+                                    post_id, comment.key().id())
                     self.redirect('/%s' % post_id) #reload page with comment
                 else:
-                    commentError = "Comment must have content in order to submit"
+                    commentError = SPAM_ERRORS.get(
+                        spamCheck, "Comment must have content in order to submit")
                     self.render('singlePost.html', title="Add Comment",
                                 commentActive=True, post=post, commentError=commentError)
             else:
                 query_params = {
                     'loginError': "You must be signed in to create a comment"}
-                self.redirect('/signup?%s' % (urllib.urlencode(query_params)))
+                self.flash_redirect('/signup', query_params)
         else:
             query_params = {'message': "That blog post does not exist"}
-            self.redirect('/?%s' % (urllib.urlencode(query_params)))
+            self.flash_redirect('/', query_params)
 
 class ModifyComment(Handler):
     """ModifyComment class used to modify existing comments. Jinja2 html template
     contains logic to display the edit and delete buttons only on comments the
     signed in user made."""
-    def get(self, comment_id):
+    def get(self, post_id, comment_id):
         if self.user:
-            comment = model.Comment.exists(comment_id)
+            comment = model.Comment.exists(post_id, comment_id)
             if comment:
                 if comment.author == self.user.userName:
-                    post = model.BlogPost.exists(comment.blogPost)
+                    post = model.BlogPost.exists(post_id)
                     self.render('singlePost.html', title="Modify Comment", post=post,
                                 commentActive=True, commentContent=comment.content,
-                                modifyComment=comment_id)
+                                modifyComment=comment_id, commentVersion=comment.version)
                     # modifyComment flag changes the action of the submit form to ModifyComment
                     # post method opposed to CommentBlog post method
                 else:
                     query_params = {
                         'commentError': "Cannot update comment you did not create"}
-                    self.redirect(
-                        '/%s?%s' % (str(comment.blogPost), urllib.urlencode(query_params)))
+                    self.flash_redirect('/%s' % str(comment.blogPost), query_params)
             else:
                 query_params = {'message': "Cannot retrieve comment, it does not exist"}
-                self.redirect('/?%s' % (urllib.urlencode(query_params)))
+                self.flash_redirect('/', query_params)
         else:
             query_params = {'loginError': "You must be signed in to delete or modify a comment post"}
-            self.redirect('/signup?%s' % (urllib.urlencode(query_params)))
+            self.flash_redirect('/signup', query_params)
 
-    def post(self, comment_id):
+    def post(self, post_id, comment_id):
         # Post method handles individual comment deletion or pushes updated comment
         # content to an existing comment.
         delete = self.request.get('delete') # This is the delete flag
-        comment = model.Comment.get_by_id(int(comment_id))
+        comment = model.Comment.exists(post_id, comment_id)
         if comment:
             blogID = str(comment.blogPost)  # Save blogID for redirect at end
             if self.user:
                 if self.user.userName == comment.author:
                     if delete: # Delete the comment
-                        post = model.BlogPost.get_by_id(comment.blogPost)
-                        # don't need to check post - if the comment exists, then the
-                        # comment.blogPost attribute will be live - if it is deleted the
-                        # comment is also deleted
-                        comment.delete()
-                        post.comments -= 1
-                        post.put()
-                        query_params = {'commentError': "Comment Deleted. May need to refresh page"}
+                        # removes the comment and decrements the post's
+                        # comment count in one transaction
+                        if comment.remove():
+                            query_params = {'commentError': "Comment Deleted."}
+                        else:
+                            query_params = {'commentError': "Comment was already deleted."}
                     else:
                         commentContent = self.request.get('commentContent')
-                        if commentContent:
-                            comment.content = commentContent
-                            comment.put()
-                            query_params = {'commentError': "Comment Updated. May need to refresh page"}
+                        spamCheck = commentContent and spam.check(
+                            commentContent, self.user.userName, blogID, comment_id)
+                        if spamCheck:
+                            query_params = {'commentError': SPAM_ERRORS[spamCheck]}
+                        elif commentContent:
+                            comment, saved = comment.update(self.request_version(),
+                                                            commentContent)
+                            if saved:
+                                spam.record(commentContent, self.user.userName,
+                                            blogID, comment_id)
+                                query_params = {'commentError': "Comment Updated."}
+                            elif comment is None:
+                                query_params = {'commentError': "Comment was deleted "
+                                                                "while you were editing it"}
+                            else:
+                                query_params = {'commentError': "Comment was changed since you "
+                                                                "started editing, please edit it again"}
                         else:
                             query_params = {'commentError': "Cannot update a comment with no content"}
-                    self.redirect('/%s?%s' % (blogID, urllib.urlencode(query_params)))
-                    # query_params used to pass status of comment deletion throughout posts
+                    self.flash_redirect('/%s' % blogID, query_params)
+                    # query_params flashed to pass status of comment deletion to the post
                 else:
                     # you can not modify a comment you did not make
                     query_params = {
                         'commentError': "Cannot update comment you did not create"}
-                    self.redirect(
-                        '/%s?%s' % (blogID, urllib.urlencode(query_params)))
+                    self.flash_redirect('/%s' % blogID, query_params)
             else:
                 query_params = {
                     'loginError': "You must be signed in to delete or modify a comment"}
-                self.redirect('/signup?%s' % (urllib.urlencode(query_params)))
+                self.flash_redirect('/signup', query_params)
 
         else:
             query_params = {'message': "Cannot modify comment, it does not exist"}
-            self.redirect('/?%s' % (urllib.urlencode(query_params)))
+            self.flash_redirect('/', query_params)
 
 
+class FlushLikes(Handler):
+    """Cron task writing buffered likes to their posts, see model.flush_likes"""
+    def get(self):
+        model.flush_likes()
+
+
+class MigrateLegacyPosts(Handler):
+    """Run once after deploying sharded posts, queues the move of root level
+    posts and comments, see model.migrate_legacy_posts"""
+    def get(self):
+        deferred.defer(model.migrate_legacy_posts)
+        self.write('Migration queued')
+
+
+class BackfillCounts(Handler):
+    """Run once after deploying precomputed counts, queues the recount of
+    counts for existing posts, see model.backfill_counts"""
+    def get(self):
+        deferred.defer(model.backfill_counts)
+        self.write('Backfill queued')
+
+
+class RebuildRelated(Handler):
+    """Daily cron task recomputing every post's related posts, see related.py"""
+    def get(self):
+        related.rebuild_all()
+
 
 app = webapp2.WSGIApplication([
     ('/', MainHandler),
@@ -419,8 +790,29 @@ app = webapp2.WSGIApplication([
     ('/login', Login),
     ('/post', BlogPost),
     ('/logout', Logout),
+    ('/search', SearchPage),
+    ('/feed.xml', FeedPage),
+    (r'/user/([a-zA-Z0-9_-]+)', AuthorPage),
+    (r'/tag/([a-z0-9-]+)', TagPage),
+    (r'/archive/([0-9]{4})/([0-9]{2})', ArchivePage),
     (r'/([0-9]+)', PostPage),
+    (r'/([0-9]+)/comments', CommentsPage),
+    (r'/([0-9]+)/revisions/([0-9]+)', RevisionPage),
+    (r'/api/like/([0-9]+)', LikeApi),
+    (r'/api/draft/(new|[0-9]+)', DraftApi),
     (r'/modify/([0-9]+)', ModifyBlog),
     (r'/comment/([0-9]+)', CommentBlog),
-    (r'/modifycomment/([0-9]+)', ModifyComment)
+    (r'/modifycomment/([0-9]+)/([0-9]+)', ModifyComment),
+    ('/tasks/flushlikes', FlushLikes),
+    ('/tasks/related', RebuildRelated),
+    ('/tasks/migrateposts', MigrateLegacyPosts),
+    ('/tasks/backfillcounts', BackfillCounts)
     ], debug=True)
+
+# Compress responses for clients that accept gzip
+app = compression.GzipMiddleware(app)
+app = storage.BudgetMiddleware(app)
+
+# Deferred tasks are routed here from app.yaml rather than through the
+# deferred builtin, so they get a datastore time budget too
+deferred_app = storage.BudgetMiddleware(deferred.application)
@@ -0,0 +1,55 @@
+"""MinHash signatures of texts for near-duplicate detection, see spam.py.
+
+A text is reduced to the set of its word shingles and summarized by the
+minimum of NUM_HASHES hash functions over the shingles. The share of
+positions two signatures agree on estimates the Jaccard similarity of their
+shingle sets. bands cuts a signature into BANDS bands for locality sensitive
+hashing: near-identical texts share at least one band with high
+probability.
+"""
+import hashlib
+import random
+import re
+import struct
+
+NUM_HASHES = 32
+BANDS = 8
+ROWS = NUM_HASHES // BANDS
+SHINGLE_SIZE = 3  # words
+
+WORD_RE = re.compile(r'\w+', re.U)
+PRIME = (1 << 61) - 1
+_random = random.Random(20161)  # fixed so every instance hashes alike
+COEFFICIENTS = [(_random.randrange(1, PRIME), _random.randrange(PRIME))
+                for i in range(NUM_HASHES)]
+
+
+def shingles(text):
+    words = WORD_RE.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return set([u' '.join(words)])
+    return set(u' '.join(words[i:i + SHINGLE_SIZE])
+               for i in range(len(words) - SHINGLE_SIZE + 1))
+
+
+def _shingle_hash(shingle):
+    digest = hashlib.md5(shingle.encode('utf-8')).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+
+def signature(text):
+    hashes = [_shingle_hash(s) for s in shingles(text)]
+    return tuple(min((a * h + b) % PRIME for h in hashes)
+                 for a, b in COEFFICIENTS)
+
+
+def similarity(first, second):
+    # Estimated Jaccard similarity of two signatures
+    same = sum(1 for x, y in zip(first, second) if x == y)
+    return same / float(NUM_HASHES)
+
+
+def bands(sig):
+    # One short digest per band of the signature
+    return [hashlib.md5(repr(sig[band * ROWS:(band + 1) * ROWS])).hexdigest()[:16]
+            for band in range(BANDS)]
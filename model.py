@@ -1,4 +1,17 @@
+import datetime
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
+from google.appengine.ext import deferred
+import cache
+import diffs
+import formatting
+import search
+import storage
 import user_accounts
 
 class User(db.Model):
@@ -15,16 +28,29 @@ class User(db.Model):
 
     @classmethod
     def by_id(cls, user_id):
-        return cls.get_by_id(user_id, parent=users_key())
+        # user_id is the value from cookieId, group-id. Cookies set before
+        # users were sharded hold just the id of a user in the default group
+        group, _, user_id = user_id.rpartition('-')
+        return storage.call('get', cls.get_by_id, int(user_id),
+                            parent=users_key(group or 'default'))
 
     @classmethod
     def by_name(cls, userName):
-        return cls.all().filter('userName =', userName).get()
+        # Ancestor query within the user's group, so a name registered a
+        # moment ago is always found. Users registered before users were
+        # sharded stay in the default group and are looked up there next,
+        # which also keeps their names taken for SignUp
+        for group in (user_group(userName), 'default'):
+            query = cls.all().ancestor(users_key(group)).filter(
+                'userName =', userName)
+            user = storage.call('query', query.get)
+            if user:
+                return user
 
     @classmethod
     def register(cls, name, password, email=None):
         passwordHash = user_accounts.make_pw_hash(name, password)
-        return User(parent = users_key(),
+        return User(parent = users_key(user_group(name)),
                     userName = name,
                     passwordHash = passwordHash,
                     email = email)
@@ -35,25 +61,169 @@ class User(db.Model):
         if userName and user_accounts.valid_pw(name, pw, userName.passwordHash):
             return userName
 
+    def cookieId(self):
+        # Value stored in the user_id cookie, see by_id
+        return '%s-%d' % (self.parent_key().name(), self.key().id())
+
+# Cached page data is served fresh for the soft TTL, then served stale while
+# a background task rebuilds it, and dropped entirely at the hard TTL
+POST_PAGE_TTL = (60, 60 * 60)
+RECENT_POSTS_TTL = (30, 60 * 60)
+# Holds the ids of the newest posts only, so the entry stays small however
+# long the posts are
+RECENT_POSTS_KEY = 'recentpostids'
+
+
+# Comments shown with the post, the rest are loaded a page at a time
+COMMENT_PAGE_SIZE = 10
+# Posts per page on listing pages such as the author page
+POST_PAGE_SIZE = 10
+# Older front pages are addressed by the creation time of the last post on
+# the page before, see BlogPost.older_than
+PAGE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+TAG_CLOUD_SIZE = 30
+TAG_CLOUD_KEY = 'tagcloud'
+ARCHIVE_KEY = 'archive'
+# Atom feed blob, see feed.py. Dropped when a post is created, edited or
+# deleted
+FEED_KEY = 'feed'
+
+
+# Bump when the tuple cached for the post page changes shape
+POST_PAGE_FORMAT = 2
+
+
+def post_page_key(blogID):
+    return 'postpage|%d|%s|%d' % (POST_PAGE_FORMAT, blogID, COMMENT_PAGE_SIZE)
+
+
+def _build_post_page(blogID):
+    post = BlogPost.exists(blogID)
+    if post:
+        comments, cursor = Comment.page(blogID)
+        related = storage.get(db.Key.from_path('RelatedPosts', str(blogID)))
+        return post, comments, cursor, related
+
+
+def post_changed(blogID):
+    # Drop everything cached that shows the post. Called after a transaction
+    # that changed the post commits, the put hooks run before the commit
+    cache.invalidate(post_page_key(blogID))
+    cache.invalidate(RECENT_POSTS_KEY)
+    cache.invalidate_pages('/', '/%s' % blogID)
+
+
+def get_post_page(blogID):
+    """Return (post, comments, cursor, related) for the post detail page
+    through the cache, or None if the post does not exist. comments is the
+    first page of comments and cursor continues from it, related is the
+    post's RelatedPosts or None. Concurrent misses are coalesced so
+    a popular post is only queried once when its entry expires"""
+    soft_ttl, hard_ttl = POST_PAGE_TTL
+    return cache.get_or_compute(post_page_key(blogID), _build_post_page,
+                                (blogID,), soft_ttl, hard_ttl)
+
+
+def author_post_count(author):
+    # Number of posts by author, read from the precomputed AuthorCount
+    authorCount = storage.get(db.Key.from_path('AuthorCount', author))
+    return authorCount.count if authorCount else 0
+
+
+def get_tag_cloud():
+    # The most used tags as (tag, count) pairs, read from the precomputed
+    # TagCount entities and cached until a tag count changes
+    cloud = memcache.get(TAG_CLOUD_KEY)
+    if cloud is None:
+        query = TagCount.all().filter('count >', 0).order('-count')
+        cloud = [(t.key().name(), t.count)
+                 for t in storage.fetch(query, TAG_CLOUD_SIZE)]
+        memcache.set(TAG_CLOUD_KEY, cloud)
+    return cloud
+
+
+def get_archive():
+    # (year, month, count) for every month with posts, newest first, read
+    # from the precomputed MonthCount entities and cached until one changes
+    archive = memcache.get(ARCHIVE_KEY)
+    if archive is None:
+        archive = []
+        for monthCount in storage.run(MonthCount.all()):
+            if monthCount.count > 0:
+                year, month = monthCount.key().name().split('-')
+                archive.append((int(year), int(month), monthCount.count))
+        archive.sort(reverse=True)
+        memcache.set(ARCHIVE_KEY, archive)
+    return archive
+
+
+def latest_posts(limit):
+    # The newest limit posts. One ancestor query per blog shard so new and
+    # deleted posts are reflected straight away, merged newest first
+    posts = []
+    for key in blog_keys():
+        query = BlogPost.all().ancestor(key).order('-created')
+        posts.extend(storage.fetch(query, limit))
+    posts.sort(key=lambda p: p.created, reverse=True)
+    return posts[:limit]
+
+
+def _build_recent_posts():
+    return [post.key().id() for post in latest_posts(POST_PAGE_SIZE)]
+
+
+def get_recent_posts():
+    # The first page of the front page, newest first. Only the ids are
+    # cached, the posts are read with one batch get
+    soft_ttl, hard_ttl = RECENT_POSTS_TTL
+    ids = cache.get_or_compute(RECENT_POSTS_KEY, _build_recent_posts, (),
+                               soft_ttl, hard_ttl)
+    return BlogPost.by_ids(ids)
+
+
+# Users are spread over this many entity groups, hashed on the user name, so
+# registrations are not limited to the write rate of a single group
+USER_GROUPS = 32
+
 def users_key(group = 'default'):
-    # group parameter for future user groups
+    # group parameter for user groups, see user_group
     return db.Key.from_path('users', group)
 
+def user_group(userName):
+    digest = hashlib.md5(userName.encode('utf-8')).hexdigest()
+    return 'group%d' % (int(digest, 16) % USER_GROUPS)
+
+# Posts are spread over this many blog entity groups so post writes are not
+# limited to the write rate of a single group
+BLOG_SHARDS = 8
+
 def blog_key(name = 'default'):
-    # group parameter for future blog groups
+    # group parameter for blog groups, see blog_shard
     return db.Key.from_path('blogs', name)
 
+def blog_shard(blogID):
+    # The blog group a post lives in is worked out from its id alone
+    return 'shard%d' % (int(blogID) % BLOG_SHARDS)
+
+def blog_keys():
+    return [blog_key(blog_shard(n)) for n in range(BLOG_SHARDS)]
+
 class BlogPost(db.Model):
     """
     Entitiy for the main blog posts. Requires a subject which is a searchable
     StringProperty, content, author, a list of users who have liked it, the number
-    of comments, creation and modification dates
+    of comments, creation and modification dates. The excerpt and rendered
+    HTML are generated from content when the post is written, see setContent
     """
     subject = db.StringProperty(required = True)
     content = db.TextProperty(required = True)
+    excerpt = db.TextProperty()
+    contentHtml = db.TextProperty()
     author = db.StringProperty(required = True)
+    tags = db.StringListProperty()
     likes = db.StringListProperty()
     comments = db.IntegerProperty(default=0)
+    version = db.IntegerProperty(default=0)
     created = db.DateTimeProperty(auto_now_add = True)
     last_modified = db.DateTimeProperty(auto_now = True)
 
@@ -61,24 +231,385 @@ class BlogPost(db.Model):
         # Used to display the number of likes in jinja template
         return len(self.likes)
 
+    def setContent(self, content):
+        # Store the content along with its excerpt and rendered HTML so views
+        # never have to process the text again
+        self.content = content
+        self.excerpt = formatting.make_excerpt(content)
+        self.contentHtml = formatting.render_html(content)
+
+    @classmethod
+    def update(cls, blogID, version, subject, content, tags):
+        """Save an edit made to the given version of the post. Compares and
+        sets the version in a transaction so an edit made to an older version
+        never overwrites a newer one. Returns (post, saved), post being the
+        current post when saved is False, or (None, False) if the post was
+        deleted"""
+        def txn():
+            post = storage.get(cls.post_key(blogID))
+            if post is None or post.version != version:
+                return post, False
+            PostRevision.record(post, content).put()
+            queue_tag_counts(tags, post.tags, transactional=True)
+            post.subject = subject
+            post.tags = tags
+            post.setContent(content)
+            post.version += 1
+            post.put()
+            search.queue_reindex(post.key(), transactional=True)
+            return post, True
+        post, saved = storage.run_in_transaction(txn)
+        if saved:
+            # put invalidated these inside the transaction, a reader may
+            # have cached the old post again before the commit
+            post_changed(blogID)
+            cache.invalidate(FEED_KEY)
+        return post, saved
+
+    @classmethod
+    def revision(cls, blogID, version):
+        """Return (revision, content) for an earlier version of the post, or
+        (post, content) for the current one. None if the post or the version
+        does not exist. The content is rebuilt from the closest full snapshot
+        at or after the version, see PostRevision"""
+        post = cls.exists(blogID)
+        if not post or not 0 <= version <= post.version:
+            return None
+        if version == post.version:
+            return post, post.content
+        revisions = storage.get([PostRevision.revision_key(post.key(), v)
+                                 for v in diffs.chain(version, post.version,
+                                                      SNAPSHOT_EVERY)])
+        content = diffs.rebuild(version, post.version, SNAPSHOT_EVERY,
+                                post.content,
+                                [r and (r.snapshot, r.delta) for r in revisions])
+        if content is None:
+            # Edited before revisions were kept
+            return None
+        return revisions[0], content
+
+    @classmethod
+    def older_than(cls, created):
+        # One page of the posts created before created, newest first. Pages
+        # the front page after the cached first page
+        query = cls.all().filter('created <', created).order('-created')
+        return storage.fetch(query, POST_PAGE_SIZE)
+
+    @classmethod
+    def by_author(cls, author, cursor = None):
+        # One page of the author's posts newest first and the cursor for the
+        # next page, uses the (author, -created) composite index
+        query = cls.all().filter('author =', author).order('-created')
+        if cursor:
+            query.with_cursor(cursor)
+        posts = storage.fetch(query, POST_PAGE_SIZE)
+        if len(posts) < POST_PAGE_SIZE:
+            return posts, None
+        return posts, query.cursor()
+
+    @classmethod
+    def by_tag(cls, tag, cursor = None):
+        # One page of posts with the tag newest first, uses the (tags,
+        # -created) composite index
+        query = cls.all().filter('tags =', tag).order('-created')
+        if cursor:
+            query.with_cursor(cursor)
+        posts = storage.fetch(query, POST_PAGE_SIZE)
+        if len(posts) < POST_PAGE_SIZE:
+            return posts, None
+        return posts, query.cursor()
+
+    @classmethod
+    def by_month(cls, year, month, cursor = None):
+        # One page of the posts created in a month newest first
+        start = datetime.datetime(year, month, 1)
+        if month == 12:
+            end = datetime.datetime(year + 1, 1, 1)
+        else:
+            end = datetime.datetime(year, month + 1, 1)
+        query = cls.all().filter('created >=', start).filter(
+            'created <', end).order('-created')
+        if cursor:
+            query.with_cursor(cursor)
+        posts = storage.fetch(query, POST_PAGE_SIZE)
+        if len(posts) < POST_PAGE_SIZE:
+            return posts, None
+        return posts, query.cursor()
+
+    @classmethod
+    def by_ids(cls, blogIDs):
+        # Posts for a list of ids in the same order, missing posts skipped
+        posts = storage.get([cls.post_key(blogID) for blogID in blogIDs])
+        return [post for post in posts if post]
+
+    @classmethod
+    def post_key(cls, blogID):
+        return db.Key.from_path('BlogPost', int(blogID),
+                                parent=blog_key(blog_shard(blogID)))
+
+    @classmethod
+    def create(cls, subject, content, author, tags):
+        # The id is allocated up front from the kind wide allocator so the
+        # post can be placed in the blog group matching its id
+        blogID = storage.call('allocate_ids', db.allocate_ids,
+                              db.Key.from_path('BlogPost', 1), 1)[0]
+        post = cls(key = cls.post_key(blogID),
+                   subject = subject,
+                   content = content,
+                   author = author,
+                   tags = tags)
+        post.setContent(content)
+        return post
+
     def addLike(self, userName):
-        # Add a username to the likes list, adding a like.
-        self.likes.append(userName)
-        self.put()
+        # Buffer a like instead of rewriting the post, flush_likes applies
+        # buffered likes in batches. Returns False if the user has already
+        # liked the post, including likes still waiting to be flushed
+        blogID = self.key().id()
+        if userName in self.likes:
+            return False
+        if not memcache.add(_liked_key(blogID, userName), True,
+                            time=LIKE_DEDUPE_TTL):
+            return False
+        taskqueue.Queue(LIKE_QUEUE).add(
+            taskqueue.Task(payload=userName, method='PULL', tag=str(blogID)))
+        memcache.incr(_pending_likes_key(blogID), initial_value=0)
+        return True
+
+    def pendingLikes(self):
+        # Likes buffered but not yet written to the post
+        return memcache.get(_pending_likes_key(self.key().id())) or 0
+
+    def publish(self):
+        """Store a post made by create and run the side effects of a new
+        post: the live id filter, search index, counts and feed. They run
+        here once the put succeeded rather than in put, because db.Model.put
+        marks the entity saved before its RPC, so a put retried by
+        storage.put could not tell it was new."""
+        key = storage.put(self) # key is complete, safe to retry
+        live_posts.added(key.id())
+        search.queue_reindex(key)
+        deferred.defer(change_author_count, self.author, 1)
+        queue_tag_counts(self.tags, [])
+        deferred.defer(change_month_count, month_name(self.created), 1)
+        cache.invalidate(FEED_KEY)
+        return key
+
+    def put(self, **kwargs):
+        kwargs.setdefault('deadline', storage.rpc_deadline())
+        key = db.Model.put(self, **kwargs)
+        cache.invalidate(post_page_key(key.id()))
+        cache.invalidate(RECENT_POSTS_KEY)
+        cache.invalidate_pages('/', '/%d' % key.id())
+        return key
+
+    def delete(self, **kwargs):
+        post_id = self.key().id()
+        kwargs.setdefault('deadline', storage.rpc_deadline())
+        db.Model.delete(self, **kwargs)
+        search.queue_reindex(self.key())
+        deferred.defer(change_author_count, self.author, -1)
+        deferred.defer(drop_related_posts, post_id)
+        queue_tag_counts([], self.tags)
+        deferred.defer(change_month_count, month_name(self.created), -1)
+        cache.invalidate(FEED_KEY)
+        cache.mark_missing('BlogPost', post_id)
+        cache.invalidate(post_page_key(post_id))
+        cache.invalidate(RECENT_POSTS_KEY)
+        cache.invalidate_pages('/', '/%d' % post_id)
 
     @classmethod
     def exists(cls, blogID):
         # Check if a given blogID exists before performing any operation on it
-        # If it does exist return True otherwise return None
-        post = cls.get_by_id(int(blogID))
+        # If it does exist return True otherwise return None. Ids known to be
+        # missing are answered from memcache without a datastore call
+        if cache.known_missing('BlogPost', blogID, live_posts):
+            return None
+        post = storage.get(cls.post_key(blogID))
         if post:
             return post
+        cache.mark_missing('BlogPost', blogID)
+
+
+# Every SNAPSHOT_EVERY-th revision keeps the full content, so rebuilding any
+# revision applies fewer than SNAPSHOT_EVERY deltas
+SNAPSHOT_EVERY = 10
+
+
+class PostRevision(db.Model):
+    """An earlier version of a post, a child of the post with the version
+    number as key name. Written by BlogPost.update as the version is
+    replaced. The content is either a full snapshot or a delta (see
+    diffs.py) that turns the next version's content into this one's"""
+    subject = db.StringProperty(required = True, indexed=False)
+    tags = db.StringListProperty(indexed=False)
+    snapshot = db.TextProperty()
+    delta = db.TextProperty()
+    last_modified = db.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def revision_key(cls, post_key, version):
+        return db.Key.from_path('PostRevision', str(version), parent=post_key)
+
+    @classmethod
+    def record(cls, post, newContent):
+        # The revision for the post as stored, about to be replaced by an
+        # edit with newContent
+        revision = cls(key=cls.revision_key(post.key(), post.version),
+                       subject=post.subject, tags=post.tags,
+                       last_modified=post.last_modified)
+        if post.version % SNAPSHOT_EVERY == 0:
+            revision.snapshot = post.content
+        else:
+            revision.delta = diffs.dumps(diffs.delta(newContent, post.content))
+        return revision
+
+    @classmethod
+    def delete_all(cls, post_key):
+        keys = storage.run(cls.all(keys_only=True).ancestor(post_key))
+        storage.call('delete', db.delete, keys)
+
+
+class RelatedPosts(db.Model):
+    """The posts most similar to a post, key name is the post id. Parallel
+    lists of post ids, their subjects and similarity scores, best first,
+    and the norm of the post's tf-idf weights. Computed by related.py.
+    postIds is indexed so a deleted post can be found in other lists"""
+    postIds = db.ListProperty(long)
+    subjects = db.StringListProperty(indexed=False)
+    scores = db.ListProperty(float, indexed=False)
+    norm = db.FloatProperty(indexed=False)
+
+    def links(self):
+        # (post id, subject) pairs for the template
+        return zip(self.postIds, self.subjects)
+
+
+def drop_related_posts(blogID):
+    # Delete a deleted post's related list and take the post off the lists
+    # of other posts. Lists written before postIds was indexed are only
+    # fixed by the nightly rebuild
+    blogID = long(blogID)
+    storage.call('delete', db.delete,
+                 db.Key.from_path('RelatedPosts', str(blogID)))
+    for related in storage.run(RelatedPosts.all().filter('postIds =', blogID)):
+        i = related.postIds.index(blogID)
+        del related.postIds[i]
+        del related.subjects[i]
+        del related.scores[i]
+        storage.put(related)
+        cache.invalidate(post_page_key(related.key().name()))
+        cache.invalidate_pages('/%s' % related.key().name())
+
+
+class TagCount(db.Model):
+    """Number of posts with a tag, key name is the tag. Kept up to date by
+    change_tag_counts as posts are created, edited and deleted"""
+    count = db.IntegerProperty(default=0)
+
+
+def queue_tag_counts(newTags, oldTags, transactional = False):
+    # Queue the count changes for a post's tags going from oldTags to newTags
+    added = [t for t in newTags if t not in oldTags]
+    removed = [t for t in oldTags if t not in newTags]
+    if added or removed:
+        deferred.defer(change_tag_counts, added, removed,
+                       _transactional=transactional)
+
+
+def change_tag_counts(added, removed):
+    def txn(tag, delta):
+        key = db.Key.from_path('TagCount', tag)
+        tagCount = storage.get(key) or TagCount(key=key)
+        tagCount.count += delta
+        tagCount.put()
+    for tag in added:
+        storage.run_in_transaction(txn, tag, 1)
+    for tag in removed:
+        storage.run_in_transaction(txn, tag, -1)
+    memcache.delete(TAG_CLOUD_KEY)
+
+
+class AuthorCount(db.Model):
+    """Number of posts by an author, key name is the author. Kept up to date
+    by change_author_count as posts are created and deleted"""
+    count = db.IntegerProperty(default=0)
+
+
+def change_author_count(author, delta):
+    def txn():
+        key = db.Key.from_path('AuthorCount', author)
+        authorCount = storage.get(key) or AuthorCount(key=key)
+        authorCount.count += delta
+        authorCount.put()
+    storage.run_in_transaction(txn)
+
+
+# Posts read per batch when recounting, see backfill_counts
+BACKFILL_BATCH_SIZE = 100
+
+
+def backfill_counts():
+    """Recount every AuthorCount and MonthCount from the posts, for posts
+    created before the counts were kept. Run once from
+    /tasks/backfillcounts, after the legacy post migration and while no
+    posts are being created or deleted."""
+    authors = {}
+    months = {}
+    query = BlogPost.all()
+    while True:
+        posts = storage.fetch(query, BACKFILL_BATCH_SIZE)
+        for post in posts:
+            authors[post.author] = authors.get(post.author, 0) + 1
+            month = month_name(post.created)
+            months[month] = months.get(month, 0) + 1
+        if len(posts) < BACKFILL_BATCH_SIZE:
+            break
+        query.with_cursor(query.cursor())
+    counts = [AuthorCount(key_name=author, count=count)
+              for author, count in authors.iteritems()]
+    counts += [MonthCount(key_name=month, count=count)
+               for month, count in months.iteritems()]
+    for start in range(0, len(counts), BACKFILL_BATCH_SIZE):
+        storage.call('put', db.put, counts[start:start + BACKFILL_BATCH_SIZE])
+    memcache.delete(ARCHIVE_KEY)
+    logging.info('Recounted posts of %d authors and %d months',
+                 len(authors), len(months))
+
+
+class MonthCount(db.Model):
+    """Number of posts created in a month, key name yyyy-mm. Kept up to date
+    by change_month_count as posts are created and deleted"""
+    count = db.IntegerProperty(default=0)
+
+
+def month_name(created):
+    return '%04d-%02d' % (created.year, created.month)
+
+
+def change_month_count(month, delta):
+    def txn():
+        key = db.Key.from_path('MonthCount', month)
+        monthCount = storage.get(key) or MonthCount(key=key)
+        monthCount.count += delta
+        monthCount.put()
+    storage.run_in_transaction(txn)
+    memcache.delete(ARCHIVE_KEY)
+
+
+def _live_post_ids():
+    return [k.id() for key in blog_keys()
+            for k in storage.run(BlogPost.all(keys_only=True).ancestor(key))]
+
+# Bloom filter of every live post id, see cache.LiveIds
+live_posts = cache.LiveIds('BlogPost', _live_post_ids)
 
 
 class Comment(db.Model):
     """
-    Comment entity used to store comments for a given blog post. Every comment
-    contains the ID of the blogpost the comment pertains to.
+    Comment entity used to store comments for a given blog post. Comments are
+    children of their blog post and also contain the ID of the blogpost the
+    comment pertains to.
     
     Also contains the class method to search through the comment entities for
     the comments which match a blogID.
@@ -86,17 +617,327 @@ class Comment(db.Model):
     blogPost = db.IntegerProperty(required = True)
     content = db.TextProperty(required = True)
     author =  db.StringProperty(required = True)
+    version = db.IntegerProperty(default=0)
     created = db.DateTimeProperty(auto_now_add=True)
     last_modified = db.DateTimeProperty(auto_now=True)
 
     @classmethod
     def get_comments_by_blogID(cls, blogID):
-        return db.GqlQuery("SELECT * FROM Comment WHERE blogPost = %s" % blogID)
+        # Ancestor query, so it always reflects the latest writes
+        return cls.all().ancestor(BlogPost.post_key(blogID)).order('created')
+
+    @classmethod
+    def page(cls, blogID, cursor = None):
+        # One page of comments and the cursor for the next page, the cursor
+        # is None once there are no more comments
+        query = cls.get_comments_by_blogID(blogID)
+        if cursor:
+            query.with_cursor(cursor)
+        comments = storage.fetch(query, COMMENT_PAGE_SIZE)
+        if len(comments) < COMMENT_PAGE_SIZE:
+            return comments, None
+        return comments, query.cursor()
+
+    @classmethod
+    def add(cls, blogID, content, author):
+        # Create the comment and bump the post's comment count in one
+        # transaction, both live in the post's entity group
+        def txn():
+            post = storage.get(BlogPost.post_key(blogID))
+            if post is None:
+                return None
+            comment = cls(parent = post,
+                          blogPost = int(blogID),
+                          content = content,
+                          author = author)
+            comment.put()
+            post.comments += 1
+            post.put()
+            return comment
+        comment = storage.run_in_transaction(txn)
+        if comment:
+            # A new comment clears any cached miss for its id
+            cache.clear_missing('Comment', _comment_path(blogID, comment.key().id()))
+        post_changed(blogID)
+        return comment
+
+    def remove(self):
+        # Delete the comment and decrement the post's comment count together.
+        # Returns False if the comment was already deleted, so concurrent
+        # deletes count it once
+        def txn():
+            comment = storage.get(self.key())
+            if comment is None:
+                return False
+            post = storage.get(self.parent_key())
+            comment.delete()
+            if post:
+                post.comments -= 1
+                post.put()
+            return True
+        removed = storage.run_in_transaction(txn)
+        if removed:
+            post_changed(self.blogPost)
+        return removed
+
+    def update(self, version, content):
+        # Compare and set edit of the comment, see BlogPost.update. Returns
+        # (None, False) if the comment was deleted
+        def txn():
+            comment = storage.get(self.key())
+            if comment is None or comment.version != version:
+                return comment, False
+            comment.content = content
+            comment.version += 1
+            comment.put()
+            return comment, True
+        comment, saved = storage.run_in_transaction(txn)
+        if saved:
+            post_changed(self.blogPost)
+        return comment, saved
+
+    def put(self, **kwargs):
+        kwargs.setdefault('deadline', storage.rpc_deadline())
+        key = db.Model.put(self, **kwargs)
+        cache.invalidate(post_page_key(self.blogPost))
+        cache.invalidate_pages('/%d' % self.blogPost)
+        return key
+
+    def delete(self, **kwargs):
+        comment_id = self.key().id()
+        kwargs.setdefault('deadline', storage.rpc_deadline())
+        db.Model.delete(self, **kwargs)
+        cache.mark_missing('Comment', _comment_path(self.blogPost, comment_id))
+        cache.invalidate(post_page_key(self.blogPost))
+        cache.invalidate_pages('/%d' % self.blogPost)
 
     @classmethod
-    def exists(cls, commentID):
+    def exists(cls, blogID, commentID):
         # Check if a given commentID exists before performing any operation on
         # it. If it does exist return True otherwise return None
-        comment = cls.get_by_id(int(commentID))
+        path = _comment_path(blogID, commentID)
+        if cache.known_missing('Comment', path):
+            return None
+        comment = storage.call('get', cls.get_by_id, int(commentID),
+                               parent=BlogPost.post_key(blogID))
         if comment:
-            return comment
\ No newline at end of file
+            return comment
+        cache.mark_missing('Comment', path)
+
+
+def _comment_path(blogID, commentID):
+    # Comment ids are only unique within their post
+    return '%s/%s' % (blogID, commentID)
+
+
+# Posts and comments written before posts were sharded are root entities.
+# migrate_legacy_posts moves them under their blog shard and post
+LEGACY_BATCH_SIZE = 20
+
+
+def _copy(entity, key):
+    # Copy of entity stored under key. last_modified is auto_now and becomes
+    # the time of the copy
+    values = dict((name, getattr(entity, name)) for name in entity.properties())
+    return entity.__class__(key=key, **values)
+
+
+def _migrate_legacy_post(key):
+    old = storage.get(key)
+    if old is None:
+        return
+    blogID = key.id()
+    post = _copy(old, BlogPost.post_key(blogID))
+    post.setContent(old.content)  # legacy posts have no excerpt or HTML
+    oldComments = [c for c in storage.run(Comment.all().filter('blogPost =', blogID))
+                   if c.parent_key() is None]
+    comments = []
+    for comment in oldComments:
+        # Keep the comment id, reserving it under the new parent so it is
+        # never handed out to a new comment
+        commentKey = db.Key.from_path('Comment', comment.key().id(),
+                                      parent=post.key())
+        storage.call('allocate_id_range', db.allocate_id_range, commentKey,
+                     commentKey.id(), commentKey.id())
+        comments.append(_copy(comment, commentKey))
+    # Copies are complete keys so the put is safe to retry. Written with
+    # db.put so the new post hooks do not run, then the ones that apply
+    storage.call('put', db.put, [post] + comments)
+    live_posts.added(blogID)
+    search.queue_reindex(post.key())
+    storage.call('delete', db.delete, [c.key() for c in oldComments] + [key])
+    cache.invalidate(post_page_key(blogID))
+    cache.invalidate_pages('/%d' % blogID)
+    logging.info('Migrated post %d with %d comments', blogID, len(comments))
+
+
+def migrate_legacy_posts(cursor = None):
+    """Move root level posts, and the root level comments of each, under
+    their blog shard and post keys, keeping their ids. Runs in batches on
+    the task queue, each batch queueing the next. Safe to run again."""
+    query = BlogPost.all(keys_only=True)
+    if cursor:
+        query.with_cursor(cursor)
+    keys = storage.fetch(query, LEGACY_BATCH_SIZE)
+    for key in keys:
+        if key.parent() is None:
+            _migrate_legacy_post(key)
+    if len(keys) == LEGACY_BATCH_SIZE:
+        deferred.defer(migrate_legacy_posts, query.cursor())
+    else:
+        cache.invalidate(RECENT_POSTS_KEY)
+        cache.invalidate(FEED_KEY)
+        cache.invalidate_pages('/')
+
+
+# Likes are buffered on a pull queue, tagged with the post id, and written in
+# batches by flush_likes which runs from cron
+LIKE_QUEUE = 'likes'
+LIKE_DEDUPE_TTL = 60 * 60
+LIKE_LEASE_SECONDS = 60
+LIKE_BATCH_SIZE = 1000
+LIKE_FLUSH_SECONDS = 30
+
+
+def _liked_key(blogID, userName):
+    return 'liked|%s|%s' % (blogID, userName)
+
+
+def _pending_likes_key(blogID):
+    return 'pendinglikes|%s' % blogID
+
+
+def flush_likes():
+    """Apply buffered likes, one transactional write per post. Likes for the
+    same post are leased together by tag and deduplicated against the
+    post's likes list, so a like storm costs a single write per batch"""
+    queue = taskqueue.Queue(LIKE_QUEUE)
+    deadline = time.time() + LIKE_FLUSH_SECONDS
+    while time.time() < deadline:
+        # without a tag, leases tasks sharing the tag of the oldest task
+        tasks = queue.lease_tasks_by_tag(LIKE_LEASE_SECONDS, LIKE_BATCH_SIZE)
+        if not tasks:
+            break
+        blogID = tasks[0].tag
+        userNames = set(task.payload for task in tasks)
+
+        def txn():
+            post = storage.get(BlogPost.post_key(blogID))
+            if post:
+                new = [u for u in userNames
+                       if u not in post.likes and u != post.author]
+                if new:
+                    post.likes.extend(new)
+                    post.put()
+                    return True
+            return False
+
+        if storage.run_in_transaction(txn):
+            post_changed(blogID)
+        queue.delete_tasks(tasks)
+        memcache.decr(_pending_likes_key(blogID), len(tasks))
+        logging.info('Flushed %d likes for post %s', len(tasks), blogID)
+
+
+# Drafts. Autosave edits are applied to a working copy in memcache and
+# written to the datastore at most once every DRAFT_SAVE_DELAY seconds
+DRAFT_SAVE_DELAY = 30
+DRAFT_TTL = 24 * 60 * 60
+DRAFT_CAS_RETRIES = 5
+
+
+class Draft(db.Model):
+    """Unsaved work on a new post or an edit, key name userName|draftID with
+    draftID 'new' or the id of the post being edited. revision counts the
+    autosave edits applied, see save_draft_edit"""
+    author = db.StringProperty(required = True)
+    subject = db.TextProperty()
+    content = db.TextProperty()
+    tags = db.TextProperty()
+    revision = db.IntegerProperty(default=0, indexed=False)
+    last_modified = db.DateTimeProperty(auto_now = True)
+
+
+def _draft_name(userName, draftID):
+    return '%s|%s' % (userName, draftID)
+
+
+def _draft_key(userName, draftID):
+    return 'draft|%s' % _draft_name(userName, draftID)
+
+
+def _draft_saving_key(userName, draftID):
+    return 'draftsaving|%s' % _draft_name(userName, draftID)
+
+
+def load_draft(userName, draftID):
+    # The working copy of a draft as a dict of subject, content, tags and
+    # revision, or None if there is no draft
+    draft = memcache.get(_draft_key(userName, draftID))
+    if draft is None:
+        stored = storage.get(db.Key.from_path(
+            'Draft', _draft_name(userName, draftID)))
+        if stored:
+            draft = {'subject': stored.subject or u'',
+                     'content': stored.content or u'',
+                     'tags': stored.tags or u'',
+                     'revision': stored.revision}
+    return draft
+
+
+def save_draft_edit(userName, draftID, subject, tags, base = None, start = 0,
+                    remove = 0, text = u'', content = None):
+    """Apply one autosave edit and return the draft's new revision. The edit
+    either replaces the content or splices text into the revision base of
+    it, in which case None is returned if the working copy is no longer at
+    base and the editor must send its whole content."""
+    client = memcache.Client()
+    key = _draft_key(userName, draftID)
+    for attempt in range(DRAFT_CAS_RETRIES):
+        draft = client.gets(key)
+        if draft is None:
+            draft = load_draft(userName, draftID)
+            current = None
+        else:
+            current = draft
+        if content is not None:
+            newContent = content
+        elif draft is None or draft['revision'] != base:
+            return None
+        else:
+            newContent = diffs.splice(draft['content'], start, remove, text)
+            if newContent is None:
+                return None
+        updated = {'subject': subject, 'content': newContent, 'tags': tags,
+                   'revision': (draft['revision'] if draft else 0) + 1}
+        if current is None:
+            stored = client.add(key, updated, time=DRAFT_TTL)
+        else:
+            stored = client.cas(key, updated, time=DRAFT_TTL)
+        if stored:
+            break
+    else:
+        return None
+    if memcache.add(_draft_saving_key(userName, draftID), True,
+                    time=DRAFT_SAVE_DELAY):
+        deferred.defer(persist_draft, userName, draftID,
+                       _countdown=DRAFT_SAVE_DELAY)
+    return updated['revision']
+
+
+def persist_draft(userName, draftID):
+    # Write the working copy to the datastore, run DRAFT_SAVE_DELAY seconds
+    # after the first edit since the last write
+    memcache.delete(_draft_saving_key(userName, draftID))
+    draft = memcache.get(_draft_key(userName, draftID))
+    if draft:
+        storage.put(Draft(key_name=_draft_name(userName, draftID),
+                          author=userName, **draft))
+
+
+def discard_draft(userName, draftID):
+    # Called once the draft is published or the post deleted
+    memcache.delete_multi([_draft_key(userName, draftID),
+                           _draft_saving_key(userName, draftID)])
+    storage.call('delete', db.delete,
+                 db.Key.from_path('Draft', _draft_name(userName, draftID)))
@@ -0,0 +1,182 @@
+"""Related posts from tf-idf similarity.
+
+Each post's term counts are computed when it is written and kept by the
+search index (search.IndexedTerms). A daily cron job weights every post's
+counts by idf, normalizes them and finds the RELATED_COUNT most similar posts
+for each post by cosine similarity. Similarities are accumulated through
+the term posting lists, so only posts sharing a term are ever compared. The
+results are stored in model.RelatedPosts so the post page reads one stored
+list. New posts are scored as soon as they are created, through the search
+postings of their terms, and added to the lists of the posts they beat.
+Deleted posts are taken off the lists by model.drop_related_posts.
+"""
+import heapq
+import logging
+import math
+
+from google.appengine.ext import db
+
+import cache
+import model
+import search
+import storage
+
+RELATED_COUNT = 5
+# Terms in more than this share of posts say little about similarity and are
+# skipped, which also keeps the posting lists walked short
+MAX_DOCUMENT_SHARE = 0.5
+
+
+def _load_counts():
+    # {post id: {term: count}} for every indexed post
+    counts = {}
+    for record in storage.run(search.IndexedTerms.all()):
+        counts[int(record.key().name())] = dict(zip(record.terms, record.counts))
+    return counts
+
+
+def _idf(counts):
+    frequency = {}
+    for terms in counts.itervalues():
+        for term in terms:
+            frequency[term] = frequency.get(term, 0) + 1
+    documents = float(len(counts))
+    return dict((term, math.log(documents / df))
+                for term, df in frequency.iteritems()
+                if df <= max(1, documents * MAX_DOCUMENT_SHARE))
+
+
+def _weights(terms, idf):
+    # Sparse tf-idf weights {term: weight}
+    return dict((term, (1 + math.log(count)) * idf[term])
+                for term, count in terms.iteritems() if idf.get(term))
+
+
+def _norm(weights):
+    return math.sqrt(sum(w * w for w in weights.itervalues()))
+
+
+def _normalize(weights):
+    norm = _norm(weights)
+    if not norm:
+        return {}
+    return dict((term, w / norm) for term, w in weights.iteritems())
+
+
+def _postings(vectors):
+    postings = {}
+    for post_id, vector in vectors.iteritems():
+        for term, weight in vector.iteritems():
+            postings.setdefault(term, []).append((post_id, weight))
+    return postings
+
+
+def _scores(post_id, vector, postings):
+    # {post id: cosine similarity} for every post sharing a term with vector
+    scores = {}
+    for term, weight in vector.iteritems():
+        for other, other_weight in postings.get(term, ()):
+            if other != post_id:
+                scores[other] = scores.get(other, 0) + weight * other_weight
+    return scores
+
+
+def _top(scores):
+    # The RELATED_COUNT best scores as (score, post id), best first
+    return heapq.nlargest(RELATED_COUNT,
+                          ((score, other) for other, score in scores.iteritems()))
+
+
+def _save(post_id, ranked, subjects, norm):
+    related = model.RelatedPosts(
+        key_name = str(post_id),
+        postIds = [long(other) for score, other in ranked],
+        subjects = [subjects.get(other, '') for score, other in ranked],
+        scores = [score for score, other in ranked],
+        norm = norm)
+    storage.put(related)
+    cache.invalidate(model.post_page_key(post_id))
+    cache.invalidate_pages('/%d' % post_id)
+
+
+def _subjects(post_ids):
+    posts = model.BlogPost.by_ids(post_ids)
+    return dict((post.key().id(), post.subject) for post in posts)
+
+
+def rebuild_all():
+    """Recompute the related list of every post. Run from cron."""
+    counts = _load_counts()
+    idf = _idf(counts)
+    weights = dict((post_id, _weights(terms, idf))
+                   for post_id, terms in counts.iteritems())
+    vectors = dict((post_id, _normalize(w)) for post_id, w in weights.iteritems())
+    postings = _postings(vectors)
+    subjects = _subjects(list(vectors))
+    for post_id, vector in vectors.iteritems():
+        _save(post_id, _top(_scores(post_id, vector, postings)), subjects,
+              _norm(weights[post_id]))
+    logging.info('Rebuilt related posts for %d posts', len(vectors))
+
+
+def add_post(post_key):
+    """Score a newly created post, store its related list and add it to the
+    lists of the posts it is now among the most similar to. Only reads the
+    search postings of the post's own terms: they give the document
+    frequencies for idf and the candidate posts with their term counts. A
+    candidate's norm is the one stored with its related list, posts
+    without one wait for the nightly rebuild."""
+    post = storage.get(post_key)
+    if not post:
+        return
+    post_id = post_key.id()
+    counts = search.term_counts(post.subject, post.content)
+    terms = sorted(counts)
+    keys = [search.postings_key(term, shard)
+            for term in terms for shard in range(search.INDEX_SHARDS)]
+    keys.append(db.Key.from_path('IndexStats', 'stats'))
+    entities = storage.get(keys)
+    stats = entities.pop()
+    shards = [p for p in entities if p]
+    # The search index may or may not have picked up the new post yet
+    indexed = any(post_id in p.postIds for p in shards)
+    documents = float((stats.documents if stats else 0) + (0 if indexed else 1))
+
+    weights = {}
+    dots = {}
+    for i, term in enumerate(terms):
+        others = [(other, count)
+                  for p in entities[i * search.INDEX_SHARDS:(i + 1) * search.INDEX_SHARDS] if p
+                  for other, count in zip(p.postIds, p.counts) if other != post_id]
+        frequency = len(others) + 1
+        if frequency > max(1, documents * MAX_DOCUMENT_SHARE):
+            continue
+        idf = math.log(documents / frequency)
+        weights[term] = (1 + math.log(counts[term])) * idf
+        for other, count in others:
+            dots[other] = (dots.get(other, 0) +
+                           weights[term] * (1 + math.log(count)) * idf)
+    norm = _norm(weights)
+
+    others = list(dots)
+    lists = storage.get([db.Key.from_path('RelatedPosts', str(other))
+                         for other in others])
+    scores = {}
+    for other, related in zip(others, lists):
+        if norm and related and related.norm:
+            scores[other] = dots[other] / (norm * related.norm)
+    ranked = _top(scores)
+    _save(post_id, ranked, _subjects([other for score, other in ranked]), norm)
+
+    # Similarity is symmetric, so the new post enters the list of any post it
+    # scores higher than that post's weakest related post
+    for other, related in zip(others, lists):
+        if other not in scores:
+            continue
+        current = zip(related.scores, related.postIds)
+        if len(current) < RELATED_COUNT or scores[other] > min(current)[0]:
+            current = heapq.nlargest(RELATED_COUNT,
+                                     current + [(scores[other], long(post_id))])
+            names = dict(zip(related.postIds, related.subjects))
+            names[post_id] = post.subject
+            _save(other, current, names, related.norm)
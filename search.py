@@ -0,0 +1,151 @@
+"""Full text search over blog posts with an inverted index in the datastore.
+
+Posts are tokenized when they are written. For every term the index keeps
+posting lists, the ids of the posts containing the term and how often it
+occurs. A term's postings are split over INDEX_SHARDS entities by post id so
+popular terms do not all land in one entity group. IndexedTerms records what
+is indexed for each post, so reindexing an edited or deleted post only
+touches the terms that changed.
+
+Queries score posts by tf-idf summed over the query terms.
+"""
+import math
+import re
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+import storage
+
+INDEX_SHARDS = 4
+SUBJECT_WEIGHT = 3  # a term in the subject counts as this many in the content
+PAGE_SIZE = 10
+
+TERM_RE = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset('''a an and are as at be but by for from has have i if in
+into is it its of on or so that the their then there these this to was were
+will with you your'''.split())
+
+
+def tokenize(text):
+    return [t for t in TERM_RE.findall(text.lower())
+            if len(t) > 1 and t not in STOPWORDS]
+
+
+def term_counts(subject, content):
+    counts = {}
+    for term in tokenize(subject):
+        counts[term] = counts.get(term, 0) + SUBJECT_WEIGHT
+    for term in tokenize(content):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+class Postings(db.Model):
+    """One shard of a term's posting list, key name term|shard. postIds and
+    counts are parallel lists"""
+    postIds = db.ListProperty(long, indexed=False)
+    counts = db.ListProperty(long, indexed=False)
+
+
+class IndexedTerms(db.Model):
+    """The terms and counts currently indexed for a post, key name post id"""
+    terms = db.StringListProperty(indexed=False)
+    counts = db.ListProperty(long, indexed=False)
+
+
+class IndexStats(db.Model):
+    # Number of indexed posts, used for idf. Single entity key name 'stats'
+    documents = db.IntegerProperty(default=0)
+
+
+def postings_key(term, shard):
+    return db.Key.from_path('Postings', '%s|%d' % (term, shard))
+
+
+def _set_posting(term, post_id, count):
+    # Set, or remove when count is 0, the post's entry in the term's postings
+    def txn():
+        key = postings_key(term, post_id % INDEX_SHARDS)
+        postings = storage.get(key) or Postings(key=key)
+        if post_id in postings.postIds:
+            i = postings.postIds.index(post_id)
+            del postings.postIds[i]
+            del postings.counts[i]
+        if count:
+            postings.postIds.append(long(post_id))
+            postings.counts.append(long(count))
+        if postings.postIds:
+            postings.put()
+        elif postings.is_saved():
+            postings.delete()
+    storage.run_in_transaction(txn)
+
+
+def _add_documents(delta):
+    def txn():
+        key = db.Key.from_path('IndexStats', 'stats')
+        stats = storage.get(key) or IndexStats(key=key)
+        stats.documents += delta
+        stats.put()
+    storage.run_in_transaction(txn)
+
+
+def queue_reindex(post_key, transactional = False):
+    # Reindex a post in the background after it is created, edited or deleted
+    deferred.defer(reindex, post_key, _transactional=transactional)
+
+
+def reindex(post_key):
+    """Bring the index in line with the stored post, or remove the post from
+    the index if it no longer exists. Safe to run repeatedly."""
+    post_id = post_key.id()
+    post = storage.get(post_key)
+    new = term_counts(post.subject, post.content) if post else {}
+    record_key = db.Key.from_path('IndexedTerms', str(post_id))
+    record = storage.get(record_key)
+    old = dict(zip(record.terms, record.counts)) if record else {}
+
+    for term in set(old) | set(new):
+        if old.get(term) != new.get(term):
+            _set_posting(term, post_id, new.get(term, 0))
+
+    if post:
+        terms = sorted(new)
+        storage.put(IndexedTerms(key=record_key, terms=terms,
+                                 counts=[long(new[t]) for t in terms]))
+        if not record:
+            _add_documents(1)
+    elif record:
+        record.delete()
+        _add_documents(-1)
+
+
+def search(query, page = 0):
+    """Return (post ids, more) for one page of results ranked by tf-idf, more
+    being True if there is another page"""
+    terms = set(tokenize(query))
+    if not terms:
+        return [], False
+    terms = sorted(terms)
+    keys = [postings_key(term, shard)
+            for term in terms for shard in range(INDEX_SHARDS)]
+    keys.append(db.Key.from_path('IndexStats', 'stats'))
+    entities = storage.get(keys)
+    stats = entities.pop()
+    documents = stats.documents if stats else 1
+
+    scores = {}
+    for i, term in enumerate(terms):
+        shards = [p for p in entities[i * INDEX_SHARDS:(i + 1) * INDEX_SHARDS] if p]
+        frequency = sum(len(p.postIds) for p in shards)
+        if not frequency:
+            continue
+        idf = math.log(1 + documents / float(frequency))
+        for postings in shards:
+            for post_id, count in zip(postings.postIds, postings.counts):
+                scores[post_id] = scores.get(post_id, 0) + (1 + math.log(count)) * idf
+
+    ranked = sorted(scores, key=lambda post_id: (-scores[post_id], -post_id))
+    start = page * PAGE_SIZE
+    return ranked[start:start + PAGE_SIZE], len(ranked) > start + PAGE_SIZE
@@ -0,0 +1,98 @@
+"""Near-duplicate and flood detection for comments.
+
+Comments are summarized by MinHash signatures (see minhash.py). Signatures
+of recent comments are kept in a locality sensitive hashing index in
+memcache: each band of a signature is hashed into a bucket, so
+near-identical comments share at least one bucket with high probability and
+only the comments in those buckets are compared. There is one index per
+author and one per post.
+
+check is called before a comment is written or edited. A comment is refused
+when the same author recently wrote a near-identical one on any post, or
+when FLOOD_LIMIT near-identical comments were recently written on the same
+post by anyone. Comments shorter than MIN_SHINGLES shingles, such as
+"Great post!", are never refused. record adds a written comment to the
+index. The index is best effort, memcache may drop buckets and concurrent
+writers can overwrite each other's updates, which only lets the odd
+duplicate through.
+"""
+import time
+
+from google.appengine.api import memcache
+
+import minhash
+
+SIMILARITY = 0.8  # estimated Jaccard similarity counted as a duplicate
+MIN_SHINGLES = 4  # shorter comments are too generic to compare
+FLOOD_LIMIT = 3  # near-identical comments by anyone on a post within WINDOW
+WINDOW = 60 * 60  # seconds comments stay in the index
+BUCKET_SIZE = 20  # most recent signatures kept per bucket
+
+DUPLICATE = 'duplicate'
+FLOOD = 'flood'
+
+
+def _bucket_keys(scope, sig):
+    return ['lsh|%s|%d|%s' % (scope, band, digest)
+            for band, digest in enumerate(minhash.bands(sig))]
+
+
+def _scopes(author, blogID):
+    return 'author:%s' % author, 'post:%s' % blogID
+
+
+def _token(blogID, commentID):
+    return '%s/%s' % (blogID, commentID)
+
+
+def _candidates(buckets, keys, exclude):
+    # Signatures of the distinct comments within WINDOW in any of the
+    # buckets, leaving out the comment exclude. Entries are (time, comment
+    # token, signature), a comment is in one bucket per band
+    since = time.time() - WINDOW
+    found = {}
+    for key in keys:
+        for added, token, sig in buckets.get(key, ()):
+            if added >= since and token != exclude:
+                found[token] = sig
+    return found.values()
+
+
+def check(content, author, blogID, commentID = None):
+    """Return None if the comment may be written, DUPLICATE if the author
+    recently wrote a near-identical comment or FLOOD if too many
+    near-identical comments were written on the post recently. commentID
+    is the comment being edited, which is not compared with itself."""
+    if len(minhash.shingles(content)) < MIN_SHINGLES:
+        return None
+    sig = minhash.signature(content)
+    authorScope, postScope = _scopes(author, blogID)
+    authorKeys = _bucket_keys(authorScope, sig)
+    postKeys = _bucket_keys(postScope, sig)
+    buckets = memcache.get_multi(authorKeys + postKeys)
+    exclude = commentID and _token(blogID, commentID)
+
+    for other in _candidates(buckets, authorKeys, exclude):
+        if minhash.similarity(sig, other) >= SIMILARITY:
+            return DUPLICATE
+    similar = sum(1 for other in _candidates(buckets, postKeys, exclude)
+                  if minhash.similarity(sig, other) >= SIMILARITY)
+    if similar >= FLOOD_LIMIT:
+        return FLOOD
+    return None
+
+
+def record(content, author, blogID, commentID):
+    # Add a written or edited comment to the index
+    if len(minhash.shingles(content)) < MIN_SHINGLES:
+        return
+    sig = minhash.signature(content)
+    keys = []
+    for scope in _scopes(author, blogID):
+        keys += _bucket_keys(scope, sig)
+    buckets = memcache.get_multi(keys)
+    entry = (time.time(), _token(blogID, commentID), sig)
+    updated = {}
+    for key in keys:
+        updated[key] = (buckets.get(key, []) + [entry])[-BUCKET_SIZE:]
+    memcache.set_multi(updated, time=WINDOW)
@@ -0,0 +1,140 @@
+"""Datastore access with deadline budgeting and retries.
+
+Each request starts a time budget (BudgetMiddleware). Every datastore call made
+through this module gets an RPC deadline no longer than what is left of the
+budget, so one slow call cannot use up the whole request. Idempotent calls
+that fail with a transient error are retried with jittered exponential
+backoff while budget remains. Retries and failures are logged and counted in
+memcache under metrics|<op>|<outcome>.
+
+Calls made inside a transaction are not retried individually, the whole
+transaction is retried by run_in_transaction.
+"""
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
+
+REQUEST_BUDGET = 50  # seconds, App Engine ends requests at 60
+TASK_BUDGET = 9 * 60 + 30  # seconds, task queue and cron requests end at 10 minutes
+MAX_RPC_DEADLINE = 10  # seconds
+MIN_RPC_DEADLINE = 0.5  # seconds, calls are never given less than this
+RETRIES = 3
+BACKOFF = 0.05  # seconds, doubled on each retry
+TRANSACTION_RETRIES = 5
+
+TRANSIENT_ERRORS = (db.Timeout, db.InternalError, db.TransactionFailedError,
+                    apiproxy_errors.DeadlineExceededError)
+
+_request = threading.local()
+
+
+def start_request(budget = REQUEST_BUDGET):
+    _request.deadline = time.time() + budget
+
+
+def end_request():
+    # Threads serve many requests, later work must not inherit the budget
+    _request.deadline = None
+
+
+class BudgetMiddleware(object):
+    """WSGI middleware giving every request its time budget, TASK_BUDGET for
+    task queue (including deferred) and cron requests and REQUEST_BUDGET
+    for the rest. App Engine strips these headers from outside requests."""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if (environ.get('HTTP_X_APPENGINE_QUEUENAME') or
+                environ.get('HTTP_X_APPENGINE_CRON')):
+            start_request(TASK_BUDGET)
+        else:
+            start_request(REQUEST_BUDGET)
+        try:
+            return self.app(environ, start_response)
+        finally:
+            end_request()
+
+
+def remaining():
+    deadline = getattr(_request, 'deadline', None)
+    if deadline is None:
+        return MAX_RPC_DEADLINE
+    return deadline - time.time()
+
+
+def rpc_deadline():
+    return max(MIN_RPC_DEADLINE, min(MAX_RPC_DEADLINE, remaining()))
+
+
+def record(op, outcome):
+    memcache.incr('metrics|%s|%s' % (op, outcome), initial_value=0)
+
+
+def _backoff(attempt):
+    # jittered exponential backoff, never sleeping past the budget
+    delay = BACKOFF * (2 ** attempt) * (1 + random.random())
+    delay = min(delay, remaining() - MIN_RPC_DEADLINE)
+    if delay <= 0:
+        return False
+    time.sleep(delay)
+    return True
+
+
+def call(op, function, *args, **kwargs):
+    """Call a datastore function with the budgeted deadline, retrying
+    transient errors. Only use for idempotent calls."""
+    if db.is_in_transaction():
+        return function(*args, deadline=rpc_deadline(), **kwargs)
+    attempt = 0
+    while True:
+        try:
+            return function(*args, deadline=rpc_deadline(), **kwargs)
+        except TRANSIENT_ERRORS as e:
+            if attempt >= RETRIES or not _backoff(attempt):
+                record(op, 'failed')
+                logging.error('%s failed after %d retries: %r', op, attempt, e)
+                raise
+            record(op, 'retry')
+            logging.warning('%s retrying after %r', op, e)
+            attempt += 1
+
+
+def get(keys):
+    return call('get', db.get, keys)
+
+
+def fetch(query, limit, **kwargs):
+    return call('fetch', query.fetch, limit, **kwargs)
+
+
+def run(query):
+    # All results of a query as a list, so a retry never repeats results
+    return call('run', lambda deadline: list(query.run(deadline=deadline)))
+
+
+def put(entity):
+    # The entity must have a complete key for the put to be safely retried
+    return call('put', entity.put)
+
+
+def run_in_transaction(function, *args):
+    """Run function in a transaction, retrying contention up to
+    TRANSACTION_RETRIES times with jittered exponential backoff."""
+    options = db.create_transaction_options(retries=0,
+                                            deadline=rpc_deadline())
+    attempt = 0
+    while True:
+        try:
+            return db.run_in_transaction_options(options, function, *args)
+        except db.TransactionFailedError:
+            if attempt >= TRANSACTION_RETRIES - 1 or not _backoff(attempt):
+                record('transaction', 'failed')
+                raise
+            record('transaction', 'retry')
+            attempt += 1
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import diffs
+
+SNAPSHOT_EVERY = 10  # as model.SNAPSHOT_EVERY
+
+
+class DeltaTest(unittest.TestCase):
+
+    def roundtrip(self, base, target):
+        ops = diffs.loads(diffs.dumps(diffs.delta(base, target)))
+        self.assertEqual(diffs.patch(base, ops), target)
+
+    def test_roundtrip(self):
+        base = u'one\ntwo\nthree\nfour\n'
+        self.roundtrip(base, base)
+        self.roundtrip(base, u'one\n2\nthree\nfour\nfive\n')
+        self.roundtrip(base, u'zero\none\nfour')
+        self.roundtrip(base, u'')
+        self.roundtrip(u'', base)
+        self.roundtrip(u'caf\xe9\r\n\U0001f600\n', u'caf\xe9\r\nno smile\n')
+
+    def test_unchanged_run_is_one_op(self):
+        base = u''.join(u'line %d\n' % i for i in range(1000))
+        target = base.replace(u'line 500\n', u'line five hundred\n')
+        ops = diffs.delta(base, target)
+        self.assertEqual(ops, [500, -1, u'line five hundred\n', 499])
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_snapshot_after(self):
+        self.assertEqual(diffs.snapshot_after(0, 25, SNAPSHOT_EVERY), 0)
+        self.assertEqual(diffs.snapshot_after(1, 25, SNAPSHOT_EVERY), 10)
+        self.assertEqual(diffs.snapshot_after(10, 25, SNAPSHOT_EVERY), 10)
+        self.assertEqual(diffs.snapshot_after(19, 25, SNAPSHOT_EVERY), 20)
+        self.assertEqual(diffs.snapshot_after(21, 25, SNAPSHOT_EVERY), 25)
+        self.assertEqual(diffs.snapshot_after(3, 7, SNAPSHOT_EVERY), 7)
+
+    def history(self, count):
+        # Versions of a text and the (snapshot, delta) pair stored for each
+        # earlier version, as model.PostRevision.record stores them
+        versions = [u'intro\n']
+        for v in range(1, count):
+            text = versions[-1] + u'paragraph %d\n' % v
+            if v % 3 == 0:
+                text = text.replace(u'intro', u'intro %d' % v)
+            versions.append(text)
+        stored = {}
+        for v in range(count - 1):
+            if v % SNAPSHOT_EVERY == 0:
+                stored[v] = (versions[v], None)
+            else:
+                stored[v] = (None, diffs.dumps(
+                    diffs.delta(versions[v + 1], versions[v])))
+        return versions, stored
+
+    def rebuild(self, version, versions, stored):
+        latest = len(versions) - 1
+        chain = diffs.chain(version, latest, SNAPSHOT_EVERY)
+        return diffs.rebuild(version, latest, SNAPSHOT_EVERY, versions[latest],
+                             [stored.get(v) for v in chain])
+
+    def test_chain(self):
+        self.assertEqual(diffs.chain(3, 25, SNAPSHOT_EVERY), range(3, 11))
+        self.assertEqual(diffs.chain(10, 25, SNAPSHOT_EVERY), [10])
+        self.assertEqual(diffs.chain(21, 25, SNAPSHOT_EVERY), range(21, 25))
+        self.assertEqual(diffs.chain(3, 7, SNAPSHOT_EVERY), range(3, 7))
+        self.assertEqual(diffs.chain(25, 25, SNAPSHOT_EVERY), [])
+
+    def test_rebuild_every_version(self):
+        versions, stored = self.history(26)
+        for version in range(len(versions)):
+            self.assertTrue(len(diffs.chain(version, 25, SNAPSHOT_EVERY))
+                            <= SNAPSHOT_EVERY)
+            self.assertEqual(self.rebuild(version, versions, stored),
+                             versions[version])
+
+    def test_short_history(self):
+        versions, stored = self.history(7)
+        for version in range(len(versions)):
+            self.assertEqual(self.rebuild(version, versions, stored),
+                             versions[version])
+
+    def test_missing_snapshot(self):
+        versions, stored = self.history(26)
+        del stored[10]
+        self.assertIsNone(self.rebuild(5, versions, stored))
+        self.assertIsNone(self.rebuild(10, versions, stored))
+        self.assertEqual(self.rebuild(15, versions, stored), versions[15])
+
+    def test_missing_delta(self):
+        # Versions edited before revisions were kept
+        versions, stored = self.history(26)
+        del stored[17]
+        self.assertIsNone(self.rebuild(12, versions, stored))
+        self.assertEqual(self.rebuild(18, versions, stored), versions[18])
+        self.assertEqual(self.rebuild(20, versions, stored), versions[20])
+
+
+class SpliceTest(unittest.TestCase):
+
+    def test_splice(self):
+        self.assertEqual(diffs.splice(u'hello world', 6, 5, u'there'),
+                         u'hello there')
+        self.assertEqual(diffs.splice(u'abc', 3, 0, u'd'), u'abcd')
+        self.assertEqual(diffs.splice(u'abc', 0, 3, u''), u'')
+
+    def test_utf16_positions(self):
+        # The emoji is two UTF-16 code units, as the editor counts it
+        content = u'a\U0001f600b'
+        self.assertEqual(diffs.splice(content, 3, 1, u'c'), u'a\U0001f600c')
+        self.assertEqual(diffs.splice(content, 1, 2, u'-'), u'a-b')
+
+    def test_bad_range(self):
+        self.assertIsNone(diffs.splice(u'abc', 2, 2, u'x'))
+        self.assertIsNone(diffs.splice(u'abc', -1, 1, u'x'))
+        self.assertIsNone(diffs.splice(u'abc', 1, -1, u'x'))
+        # Inside the surrogate pair
+        self.assertIsNone(diffs.splice(u'a\U0001f600b', 2, 0, u'x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
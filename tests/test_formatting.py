@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import formatting
+
+
+class ExcerptTest(unittest.TestCase):
+
+    def test_short_content(self):
+        self.assertEqual(formatting.make_excerpt(u'  a\n\nb  c '), u'a b c')
+
+    def test_cut_on_word(self):
+        excerpt = formatting.make_excerpt(u'alpha beta gamma', 12)
+        self.assertEqual(excerpt, u'alpha beta…')
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_paragraphs(self):
+        html = formatting.render_html(u'one\r\ntwo\r\n\r\n  \r\nthree\n')
+        self.assertEqual(html, u'<p>one<br>\ntwo</p>\n<p>three</p>')
+
+    def test_escapes(self):
+        html = formatting.render_html(u'<script>"x" & y</script>')
+        self.assertEqual(
+            html, u'<p>&lt;script&gt;&quot;x&quot; &amp; y&lt;/script&gt;</p>')
+
+
+class TagsTest(unittest.TestCase):
+
+    def test_parse_tags(self):
+        self.assertEqual(formatting.parse_tags(u'Python, app engine,python, '),
+                         [u'python', u'app-engine'])
+
+    def test_rejects_bad_tags(self):
+        self.assertEqual(formatting.parse_tags(u'-dash, c++, ok'), [u'ok'])
+
+    def test_limit(self):
+        text = u','.join(u'tag%d' % i for i in range(20))
+        self.assertEqual(len(formatting.parse_tags(text)), formatting.MAX_TAGS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import minhash
+
+TEXT = (u'Buy cheap watches at our online store today, free shipping on '
+        u'every order over fifty dollars')
+
+
+class MinHashTest(unittest.TestCase):
+
+    def test_shingles(self):
+        self.assertEqual(minhash.shingles(u'One two, THREE four'),
+                         set([u'one two three', u'two three four']))
+        self.assertEqual(minhash.shingles(u'Great post!'),
+                         set([u'great post']))
+
+    def test_signature_is_stable(self):
+        sig = minhash.signature(TEXT)
+        self.assertEqual(len(sig), minhash.NUM_HASHES)
+        self.assertEqual(sig, minhash.signature(TEXT.upper()))
+
+    def test_similarity(self):
+        sig = minhash.signature(TEXT)
+        near = minhash.signature(TEXT + u' today')
+        other = minhash.signature(u'I disagree with the second paragraph, '
+                                  u'the benchmark numbers look off to me')
+        self.assertEqual(minhash.similarity(sig, sig), 1.0)
+        self.assertTrue(minhash.similarity(sig, near) >= 0.7)
+        self.assertTrue(minhash.similarity(sig, other) <= 0.2)
+
+    def test_bands(self):
+        sig = minhash.signature(TEXT)
+        near = minhash.signature(TEXT + u' today')
+        bands = minhash.bands(sig)
+        self.assertEqual(len(bands), minhash.BANDS)
+        self.assertEqual(bands, minhash.bands(sig))
+        self.assertTrue(set(bands) & set(minhash.bands(near)))
+
+
+if __name__ == '__main__':
+    unittest.main()